@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Measure OSC dispatch throughput in AMCPServer.
+
+Sends a mix of TouchOSC fader, XY pad and grid button messages through
+catch_all() directly, and then through liblo over UDP to the server's own port.
+Held fader values are flushed every --per-frame messages, as if a frame ran.
+Prints one JSON object per mode, with messages per second and how many messages
+were actually applied.
+
+    $ bench/dispatch.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import liblo
+import server
+
+# Messages without side effects outside this process. Grid buttons are released
+# rather than pressed, so nothing gets loaded or played.
+MESSAGES = [
+    ('/light2/brightness', [0.5]),
+    ('/light2/contrast', [0.3]),
+    ('/light2/detail', [0.4]),
+    ('/light2/turbulence', [0.6]),
+    ('/light2/heading', [0.1, 0.2]),
+    ('/light2/rotation', [0.3, 0.4]),
+    ('/light/cloud_z', [0.2]),
+    ('/light3/loadsave/1/2', [0.0]),
+    ('/smb/smb_effects/2/3', [0.0]),
+]
+
+
+def direct(amcp, count, perFrame):
+    messages = (MESSAGES * (count // len(MESSAGES) + 1))[:count]
+    start = time.time()
+    for i, (path, args) in enumerate(messages):
+        amcp.catch_all(path, args)
+        if i % perFrame == 0:
+            amcp.flush_pending()
+    amcp.flush_pending()
+    return count / (time.time() - start)
+
+
+def overUDP(amcp, port, count, perFrame):
+    target = liblo.Address('127.0.0.1', port)
+    received = 0
+    start = time.time()
+
+    # Send in batches small enough not to overflow the socket's receive buffer
+    while received < count:
+        for path, args in MESSAGES:
+            liblo.send(target, path, *args)
+        for i in range(len(MESSAGES)):
+            if amcp.recv(100):
+                received += 1
+                if received % perFrame == 0:
+                    amcp.flush_pending()
+    amcp.flush_pending()
+    return received / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--per-frame', type=int, default=10,
+        help='Messages between frames, when held fader values are applied')
+    args = parser.parse_args()
+
+    amcp = server.AMCPServer(port=args.port, client_ip='127.0.0.1', client_port=args.port + 1)
+
+    for mode, run in (
+            ('direct', lambda: direct(amcp, args.messages, args.per_frame)),
+            ('udp', lambda: overUDP(amcp, args.port, args.messages, args.per_frame))):
+        amcp.received = amcp.applied = 0
+        rate = run()
+        result = {'mode': mode, 'messages': amcp.received, 'applied': amcp.applied,
+            'messages_per_sec': rate}
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
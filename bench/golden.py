@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Record or check golden frames from the lighting effects.
+
+Record a reference before changing the renderer, then check against it afterward.
+Golden files depend on the platform and compiler flags, so record and check on the
+same machine. Prints a JSON result, and exits with status 1 if the check fails.
+
+    $ bench/golden.py record /tmp/golden.npz
+    $ bench/golden.py check /tmp/golden.npz --tolerance 1
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from effects import golden
+
+DEFAULT_LAYOUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'layout', 'amcp-leds.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('action', choices=['record', 'check'])
+    parser.add_argument('filename')
+    parser.add_argument('--layout', default=DEFAULT_LAYOUT)
+    parser.add_argument('--frames', type=int, default=300, help='Frames to record')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed to record with')
+    parser.add_argument('--tolerance', type=int, default=0,
+        help='Largest allowed difference in any color channel, or 0 for identical frames')
+    args = parser.parse_args()
+
+    if args.action == 'record':
+        frames = golden.record(args.filename, args.frames, args.seed, args.layout)
+        result = {'frames': len(frames), 'checksum': golden.checksums([frames])[0]}
+    else:
+        result = golden.compare(args.filename, args.tolerance, args.layout)
+
+    print json.dumps(result, sort_keys=True)
+    if not result.get('ok', True):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
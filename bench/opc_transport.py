@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Compare per-frame OPC send latency and CPU cost over TCP and Unix sockets.
+
+Sends full-size frames from a FastOPC client to an OPCSink running in a separate
+process, so the CPU time we measure belongs to the client. Prints one JSON object
+per transport.
+
+    $ bench/opc_transport.py --frames 3000 --fps 30
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import opcsink
+from effects import fastopc
+
+# Cloud pixels plus DMX, as sent by LightController
+DEFAULT_FRAME_BYTES = 2368 * 3 + 3
+
+
+def serveSink(server, queue):
+    sink = opcsink.OPCSink(server, parse=False)
+    queue.put(sink.server)
+    while True:
+        time.sleep(1)
+
+
+def benchmark(transport, server, frames, frameBytes, fps):
+    queue = multiprocessing.Queue()
+    sinkProcess = multiprocessing.Process(target=serveSink, args=(server, queue))
+    sinkProcess.daemon = True
+    sinkProcess.start()
+    server = queue.get()
+
+    opc = fastopc.FastOPC(server)
+    frame = opc.makeFrame(0, frameBytes)
+
+    # Connect before we start measuring
+    while not opc.send(frame):
+        pass
+
+    latencies = numpy.zeros(frames)
+    period = fps and 1.0 / fps
+    nextFrame = time.time()
+    startUsage = resource.getrusage(resource.RUSAGE_SELF)
+
+    for i in range(frames):
+        if period:
+            nextFrame += period
+            delay = nextFrame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        start = time.time()
+        opc.send(frame)
+        latencies[i] = time.time() - start
+
+    endUsage = resource.getrusage(resource.RUSAGE_SELF)
+    sinkProcess.terminate()
+
+    # getrusage() counts in microseconds, where os.times() only has clock ticks
+    cpu = ((endUsage.ru_utime - startUsage.ru_utime) +
+           (endUsage.ru_stime - startUsage.ru_stime))
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    return {
+        'transport': transport,
+        'frames': frames,
+        'frame_bytes': frameBytes,
+        'fps': fps,
+        'send_p50_us': p50 * 1e6,
+        'send_p95_us': p95 * 1e6,
+        'send_p99_us': p99 * 1e6,
+        'send_max_us': latencies.max() * 1e6,
+        'cpu_us_per_frame': cpu / frames * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--frame-bytes', type=int, default=DEFAULT_FRAME_BYTES)
+    parser.add_argument('--fps', type=float, default=30,
+        help='Frame rate to send at, or 0 to send as fast as possible')
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        for transport, server in (
+                ('tcp', '127.0.0.1:0'),
+                ('unix', 'unix:' + os.path.join(tempdir, 'opc.sock'))):
+            result = benchmark(transport, server, args.frames, args.frame_bytes, args.fps)
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Minimal Open Pixel Control server, as a local stand-in for fcserver."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import socket
+import struct
+import threading
+import time
+
+from effects import fastopc
+
+
+class OPCSink(object):
+    """Accepts OPC connections on a TCP or Unix socket, and parses and counts the messages.
+       Useful for tests and benchmarks that need something on the other end of a FastOPC.
+
+       'server' uses the same format as FastOPC. For TCP, port 0 picks a free port; the
+       actual address to connect to is in self.server afterwards. With parse=False, incoming
+       data is only counted (in self.bytes), which keeps the sink cheap for benchmarks.
+       """
+
+    def __init__(self, server='127.0.0.1:0', parse=True):
+        family, address = fastopc.parseAddress(server)
+
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.listener.bind(address)
+        self.listener.listen(4)
+
+        if family == socket.AF_INET:
+            self.server = '%s:%d' % self.listener.getsockname()
+        else:
+            self.server = server
+        self.address = address
+        self.family = family
+        self.parse = parse
+
+        self.messages = 0
+        self.bytes = 0
+        self.lastMessage = {}       # Latest (command, data) for each channel
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._acceptLoop, name='opc-sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def waitForMessages(self, count, timeout=5.0):
+        """Wait until at least 'count' messages have arrived. Returns True on success."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.messages < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        self._closed = True
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _acceptLoop(self):
+        while not self._closed:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self._connectionLoop, args=(conn,), name='opc-sink-conn')
+            t.daemon = True
+            t.start()
+
+    def _connectionLoop(self, conn):
+        buffer = ''
+        while not self._closed:
+            try:
+                data = conn.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            if not self.parse:
+                self.bytes += len(data)
+                continue
+            buffer += data
+
+            # Parse all complete messages
+            offset = 0
+            while len(buffer) - offset >= 4:
+                channel, command, length = struct.unpack_from('>BBH', buffer, offset)
+                end = offset + 4 + length
+                if end > len(buffer):
+                    break
+                with self._cond:
+                    self.lastMessage[channel] = (command, buffer[offset + 4:end])
+                    self.messages += 1
+                    self.bytes += end - offset
+                    self._cond.notifyAll()
+                offset = end
+            buffer = buffer[offset:]
+        conn.close()
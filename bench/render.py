@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Headless benchmark for the lighting effects pipeline.
+
+Runs LightController frames against a null OPC sink, on a fake clock so nothing
+ever sleeps, and sweeps the LED count, the number of live lightning bolts and the
+number of noise octaves. Larger layouts are made by tiling the real one side by side.
+Prints one JSON object per configuration, so results from two commits can be diffed.
+
+    $ bench/render.py --scales 1,2,5,10 --lightning 0,10 --octaves 1,4
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+
+import numpy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import effects
+from effects import cloud, fastopc, profiler
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_LAYOUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'layout', 'amcp-leds.json')
+
+
+def intList(text):
+    return [int(x) for x in text.split(',')]
+
+
+def tiledModel(base, scale):
+    """A Model with 'scale' copies of the base layout's points, side by side along X."""
+    width = base.pointMax[0] - base.pointMin[0] + 0.5
+    offsets = numpy.zeros((scale, 1, 3))
+    offsets[:, 0, 0] = numpy.arange(scale) * width
+    return effects.Model(points=(base.points[numpy.newaxis] + offsets).reshape((-1, 3)))
+
+
+def countAllocations(run):
+    """Call run(), returning (allocations, method). With tracemalloc, this is the number of
+       memory blocks still allocated afterwards. Otherwise it's the net number of new
+       objects tracked by the garbage collector, which includes every list, tuple and dict.
+       Neither counts short-lived allocations that were freed again.
+       """
+
+    if tracemalloc:
+        tracemalloc.start()
+        before = len(tracemalloc.take_snapshot().traces)
+        run()
+        after = len(tracemalloc.take_snapshot().traces)
+        tracemalloc.stop()
+        return after - before, 'tracemalloc-blocks'
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        run()
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return after - before, 'gc-objects'
+
+
+def benchmark(model, lightning, octaves, frames, threads):
+    clock = profiler.FakeClock()
+    opc = fastopc.NullOPC()
+    controller = effects.LightController(model, opc=opc, clock=clock, sleep=clock.sleep,
+        maxLightning=lightning, renderThreads=threads, lightningThreshold=1 / 255.0, profile=True)
+    controller.profileLogPeriod = 0
+
+    # A fixed set of long-lived bolts, so every frame renders the same amount of lightning
+    rng = random.Random(1)
+    params = controller.params
+    params.lightning_new = params.lightning_chain = 0
+    params.octaves = octaves
+    for i in range(lightning):
+        controller.lightning.append(effects.LightningBolt(
+            [rng.uniform(model.pointMin[j], model.pointMax[j]) for j in range(3)],
+            chainable=False, strength=0.8, falloff=rng.uniform(2.0, 5.0),
+            fadeDuration=1.0, flickerDuration=1e9, rng=rng))
+
+    # Warm up caches and the thread pool
+    for i in range(10):
+        controller.runFrame()
+    controller.profiler.reset()
+
+    def run():
+        for i in range(frames):
+            controller.runFrame()
+
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+
+    allocations, method = countAllocations(run)
+    render = controller.profiler.report()['stages']['render']
+    leds = len(model.points)
+
+    return {
+        'leds': leds,
+        'lightning': lightning,
+        'octaves': octaves,
+        'threads': cloud.get_threads(),
+        'frames': frames,
+        'fps': frames / elapsed,
+        'ns_per_led': elapsed / frames / leds * 1e9,
+        'render_p50_us': render['p50'] * 1e6,
+        'render_p99_us': render['p99'] * 1e6,
+        'allocations_per_frame': allocations / float(frames),
+        'allocation_method': method,
+        'bytes_per_frame': opc.bytes / float(opc.messages),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--layout', default=DEFAULT_LAYOUT)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--scales', type=intList, default=[1, 2, 5, 10],
+        help='Comma-separated layout sizes, as multiples of the real layout')
+    parser.add_argument('--lightning', type=intList, default=[0, 10],
+        help='Comma-separated numbers of live lightning bolts')
+    parser.add_argument('--octaves', type=intList, default=[cloud.NUM_OCTAVES],
+        help='Comma-separated noise octave counts')
+    parser.add_argument('--threads', type=int, default=1, help='Native render threads')
+    args = parser.parse_args()
+
+    base = effects.Model(args.layout)
+    for scale in args.scales:
+        model = tiledModel(base, scale)
+        for lightning in args.lightning:
+            for octaves in args.octaves:
+                result = benchmark(model, lightning, octaves, args.frames, args.threads)
+                result['scale'] = scale
+                print json.dumps(result, sort_keys=True)
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
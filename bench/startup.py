@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Measure how long the lighting effects take to start up.
+
+Loads a copy of the layout (so the real cache is left alone) by parsing the JSON,
+then through the compiled layout cache, then builds a whole LightController and
+renders its first frame. Prints one JSON object per step, with the median time
+over --repeat runs.
+
+    $ bench/startup.py --repeat 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import effects
+from effects import fastopc, layout, profiler
+
+DEFAULT_LAYOUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'layout', 'amcp-leds.json')
+
+
+def timed(run, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    return numpy.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--layout', default=DEFAULT_LAYOUT)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, os.path.basename(args.layout))
+        shutil.copy(args.layout, filename)
+        layout.compile(filename)
+
+        def parseJSON():
+            # Parsed the way Model does without a cache, but without writing one
+            with open(filename, 'rb') as f:
+                effects.Model(filename, layout.parse(f.read()))
+
+        def firstFrame():
+            clock = profiler.FakeClock()
+            controller = effects.LightController(filename, opc=fastopc.NullOPC(),
+                clock=clock, sleep=clock.sleep)
+            controller.runFrame()
+
+        for step, run in (
+                ('model_json', parseJSON),
+                ('model_cached', lambda: effects.Model(filename)),
+                ('first_frame', firstFrame)):
+            result = {'step': step, 'seconds': timed(run, args.repeat), 'repeat': args.repeat}
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,10 @@ import random
 
 import cloud
 import fastopc
+import governor
+import layout
+import playback
+import profiler
 
 # Sunset color lookup table (Based on a photo of the horizon)
 colorTable = numpy.array([(170, 85, 39), (173, 87, 39), (177, 90, 40), (180, 92, 40), (184, 95, 41),
@@ -80,6 +84,15 @@ colorTable = numpy.array([(170, 85, 39), (173, 87, 39), (177, 90, 40), (180, 92,
     (64, 88, 128), (64, 88, 128), (64, 87, 127), (63, 87, 127), (63, 87, 126), (63, 86, 126),
     (63, 86, 125), (62, 86, 125), (62, 86, 125), (62, 85, 124)])
 
+# The same colors, linearly interpolated up to enough entries that looking up the nearest
+# one is as good as interpolating. Scaled from 0-255 to 0-1, as float32 for our native code.
+colorLUTSize = 4096
+colorLUT = numpy.empty((colorLUTSize, 3), dtype=numpy.float32)
+for _i in range(3):
+    colorLUT[:,_i] = numpy.interp(numpy.linspace(0.0, 1.0, colorLUTSize),
+        numpy.linspace(0.0, 1.0, colorTable.shape[0]), colorTable[:,_i]) / 255.0
+del _i
+
 
 
 class Model(object):
@@ -89,12 +102,21 @@ class Model(object):
        indices used by the OPC server.
        """
 
-    def __init__(self, filename):
-        # Raw graph data
-        self.graphData = json.load(open(filename))
+    # Size of the cubes in our spatial grid, in meters
+    gridCellSize = 0.25
+
+    _graphData = None
+
+    def __init__(self, filename=None, points=None):
+        # A model can also be made directly from a list of points, for example
+        # a synthetic layout for benchmarking. Layout files are loaded through
+        # a binary cache, so the JSON is only parsed when it changes.
+        self.filename = filename
+        if points is None:
+            points = layout.load(filename)
 
         # Points, as a NumPy array
-        self.points = numpy.array([x['point'] for x in self.graphData])
+        self.points = numpy.array(points, dtype=float)
 
         # Axis-aligned bounding box
         self.pointMin = numpy.min(self.points, axis=0)
@@ -103,6 +125,30 @@ class Model(object):
         # Packed buffer, ready to pass to our native code
         self.packed = self.points.astype(numpy.float32).tostring()
 
+        # Height of each LED, from 0 at the bottom to 1 at the top
+        height = self.pointMax[2] - self.pointMin[2]
+        self.normalizedZ = ((self.points[:,2] - self.pointMin[2]) / (height or 1.0)).astype(numpy.float32)
+
+        # Uniform grid over the bounding box, in the tuple format our native code uses
+        # for culling lightning. Holds the grid cell index for each LED.
+        cells = numpy.floor((self.points - self.pointMin) / self.gridCellSize).astype(int)
+        dims = cells.max(axis=0) + 1
+        index = (cells[:,2] * dims[1] + cells[:,1]) * dims[0] + cells[:,0]
+        self.grid = (index.astype(numpy.int32).tostring(),
+            int(dims[0]), int(dims[1]), int(dims[2]),
+            float(self.pointMin[0]), float(self.pointMin[1]), float(self.pointMin[2]),
+            self.gridCellSize)
+
+    @property
+    def graphData(self):
+        # Raw graph data, only parsed from the layout file if someone asks for it
+        if self._graphData is None:
+            if self.filename is None:
+                self._graphData = [{'point': list(p)} for p in self.points]
+            else:
+                self._graphData = json.load(open(self.filename))
+        return self._graphData
+
 
 class LightParameters(object):
     """Container for parameters that are intended to be tweaked by the performer, via OSC."""
@@ -110,6 +156,13 @@ class LightParameters(object):
     # How much detail is visible (scale factor)
     detail = 0.8
 
+    # Shape of the fractal noise. Each octave adds detail at 'lacunarity' times the
+    # frequency and 'persistence' times the amplitude of the one before. Rendering time
+    # is proportional to the number of octaves.
+    octaves = 4
+    persistence = 0.5
+    lacunarity = 2.0
+
     # How fast the cloud shape changes over time. 0 == perfectly still.
     turbulence = 0.4
 
@@ -141,23 +194,36 @@ class LightParameters(object):
     # cloud once it's already started.
     lightning_chain = 0.1
 
+    def update(self, other):
+        """Copy every parameter from another LightParameters object."""
+        for name in self.names:
+            setattr(self, name, getattr(other, name))
+
+# Names of all the parameters, in a fixed order
+LightParameters.names = tuple(sorted(name for name, value in vars(LightParameters).items()
+    if isinstance(value, (int, float))))
+
+# Parameters which are angles, in radians
+LightParameters.angles = ('rotation', 'wind_heading')
+
 
 class LightningBolt(object):
     """A single in-cloud lightning bolt."""
 
     def __init__(self, position, chainable=True,
-            strength=None, falloff=None, fadeDuration=None, flickerDuration=None):
+            strength=None, falloff=None, fadeDuration=None, flickerDuration=None, rng=random):
 
         self.position = position
         self.chainable = chainable
+        self.rng = rng
 
         # Shape of this bolt
-        self.strength = strength or abs(random.gauss(0.5, 0.2))
-        self.falloff = falloff or random.uniform(2.0, 5.0)
+        self.strength = strength or abs(rng.gauss(0.5, 0.2))
+        self.falloff = falloff or rng.uniform(2.0, 5.0)
 
         # Timeline
-        self.fadeDuration = fadeDuration or abs(random.gauss(0.1, 0.2))
-        self.flickerDuration = flickerDuration or abs(random.gauss(0.1, 0.5))
+        self.fadeDuration = fadeDuration or abs(rng.gauss(0.1, 0.2))
+        self.flickerDuration = flickerDuration or abs(rng.gauss(0.1, 0.5))
         self.lifetime = self.fadeDuration + self.flickerDuration
 
     def render(self):
@@ -169,7 +235,7 @@ class LightningBolt(object):
             luma = self.lifetime * self.strength / self.fadeDuration
         else:
             # Flickering
-            luma = random.gauss(self.strength, 0.05)
+            luma = self.rng.gauss(self.strength, 0.05)
 
         # Bolts are all plain white for now
         color = [luma] * 3
@@ -180,17 +246,51 @@ class LightningBolt(object):
 class LightController(object):
     """Light effect controller. Stores effect parameters, and runs our main loop which
        calculates pixel values and streams them to the Open Pixel Control server.
+
+       'layout' is a JSON layout file or a Model. Instead of connecting to 'server', frames
+       can go to an existing OPC client object given as 'opc'. The 'clock' and 'sleep'
+       functions default to the real ones, and can be replaced to run without real time.
+       With a 'seed', lightning comes from a private random number generator, so the same
+       parameters and clock reproduce the same frames exactly.
+
+       Frames normally go to one server as a single channel 0 message. With 'outputs', a
+       mapping of pixels to OPC channels and servers (see fastopc.MultiOPC), each channel
+       is sent separately, and each server over its own connection and sender thread.
        """
 
+    _colors = None
     _colorBuffer = None
     _colorBufferKey = None
-
-    def __init__(self, layout="layout/amcp-leds.json", server=None, targetFPS=30, maxLightning=10, showFPS=False):
-        self.model = Model(layout)
-        self.opc = fastopc.FastOPC(server)
+    _renderKey = None
+
+    def __init__(self, layout="layout/amcp-leds.json", server=None, targetFPS=30, maxLightning=10, showFPS=False,
+            renderThreads=None, lightningThreshold=None, profile=False, profileLogPeriod=60,
+            threadedOPC=False, keepalive=None, adaptive=False, opc=None,
+            clock=time.time, sleep=time.sleep, seed=None, outputs=None):
+        if isinstance(layout, Model):
+            self.model = layout
+        else:
+            self.model = Model(layout)
+
+        # With threadedOPC, frames are sent from a background thread and a slow or missing
+        # OPC server never blocks the render loop. With a keepalive interval, unchanged
+        # frames are only re-sent that often.
+        if opc is not None:
+            self.opc = opc
+        elif outputs is not None:
+            # Always threaded, whatever 'threadedOPC' says. Otherwise servers are sent
+            # to one after another, and each unreachable one stalls every frame.
+            self.opc = fastopc.MultiOPC(outputs, keepalive)
+        elif threadedOPC:
+            self.opc = fastopc.ThreadedOPC(server, keepalive)
+        else:
+            self.opc = fastopc.FastOPC(server, keepalive)
         self.targetFPS = targetFPS
         self.showFPS = showFPS
-        self.time = time.time()
+        self.clock = clock
+        self.sleep = sleep
+        self.time = clock()
+        self.random = random if seed is None else random.Random(seed)
 
         # Current translation vector
         self.translation = [0,0,0,0]
@@ -198,20 +298,94 @@ class LightController(object):
         # Parameters, intended to be modified by the server code
         self.params = LightParameters()
 
+        # Parameters on their way to new values, as {name: (start value, change, final
+        # value, start time, duration, last value set)}. See transitionTo().
+        self._transitions = {}
+
+        # Preallocated OPC message for each frame: header, cloud pixels, then DMX.
+        # Pixels are rendered in place, and the DMX array is a view into the same
+        # buffer, so steady-state frames go from render to socket without copies.
+        self._pixelBytes = len(self.model.packed) // 4
+        self._frame = self.opc.makeFrame(0, self._pixelBytes + 3)
+
         # Array with state of DMX devices. (TODO)
-        self.dmx = numpy.zeros((1, 3), numpy.uint8)
+        # Modify this in place; it's sent as part of every frame.
+        self.dmx = numpy.frombuffer(self._frame, numpy.uint8, 3,
+            self.opc.headerBytes + self._pixelBytes).reshape((1, 3))
+
+        # Views of the other parts of the frame, for show playback
+        self._pixels = numpy.frombuffer(self._frame, numpy.uint8, self._pixelBytes, self.opc.headerBytes)
+        self._frameHeader = buffer(self._frame, 0, self.opc.headerBytes)
+        self._frameDMX = buffer(self._frame, self.opc.headerBytes + self._pixelBytes)
+
+        # Precomputed show we're playing, if any. See playShow().
+        self.playback = None
 
         # Array of live lightning bolt objects
         self.lightning = []
         self.maxLightning = maxLightning
+        self._lastLightningCount = 0
+
+        # Upper limit on params.octaves. Fewer is faster, with less fine detail.
+        self.octaves = cloud.MAX_OCTAVES
+
+        # Frames where we skipped rendering, because the result couldn't have changed
+        self.skippedRenders = 0
+
+        # If set, lightning is only calculated for LEDs near enough that it can add at least
+        # this much (out of 1.0) to some color channel. Uses the model's spatial grid.
+        self.lightningThreshold = lightningThreshold
+
+        # Native render threads. This is a process-wide setting, so leave it alone if unspecified.
+        if renderThreads is not None:
+            cloud.set_threads(renderThreads)
 
         self._fpsFrames = 0
         self._fpsTime = 0
         self._fpsLogPeriod = 0.5    # How often to log frame rate
 
+        # Optional per-stage timing. The report is available any time from
+        # self.profiler.report(), and it's logged every 'profileLogPeriod' seconds.
+        self.profiler = None
+        if profile:
+            self.profiler = profiler.FrameProfiler(1.0 / targetFPS)
+        self.profileLogPeriod = profileLogPeriod
+        self._profileLogTime = self.time
+
+        # Optional automatic quality control. Adjusts octaves, maxLightning and targetFPS.
+        self.governor = None
+        if adaptive:
+            self.governor = governor.FrameGovernor(self)
+
+    def nextFrameTime(self):
+        """Time on our clock when the next frame is due. An event loop can wait until then,
+           handling other events, and call runFrame() on time so it never has to sleep.
+           """
+        return self.time + 1.0 / self.targetFPS
+
+    def noteInput(self):
+        """A control message just arrived. Used for measuring input-to-light latency."""
+        if self.profiler:
+            self.profiler.input()
+
     def runFrame(self):
         """Run one frame of our main rendering loop."""
-        self._drawFrame(self._advanceTime())
+        dt = self._advanceTime()
+        start = self.clock()
+
+        if self.profiler:
+            self.profiler.begin()
+            self._drawFrame(dt)
+            self.profiler.end()
+
+            if self.profileLogPeriod and self.time > self._profileLogTime + self.profileLogPeriod:
+                self._profileLogTime = self.time
+                self.profiler.log()
+        else:
+            self._drawFrame(dt)
+
+        if self.governor:
+            self.governor.update(self.clock() - start)
 
     def _advanceTime(self):
         """Update our virtual clock (self.time)
@@ -226,7 +400,7 @@ class LightController(object):
            tell how well we're doing.
            """
 
-        now = time.time()
+        now = self.clock()
         dt = now - self.time
         dtIdeal = 1.0 / self.targetFPS
 
@@ -245,7 +419,7 @@ class LightController(object):
             self.time += dtIdeal
             animationDt = dtIdeal
             if dt < dtIdeal:
-                time.sleep(dtIdeal - dt)
+                self.sleep(dtIdeal - dt)
 
         # Log frame rate
 
@@ -289,10 +463,70 @@ class LightController(object):
                  0,       0,    z,    0,
                  t[0], t[1], t[2], t[3] ]
 
+    def playShow(self, show, fade=1.0, loop=False):
+        """Start playing a precomputed show, from a filename or playback.ShowFile.
+           Crossfades from the live effect over 'fade' seconds, and unless looping,
+           back to it over the last 'fade' seconds of the show.
+           """
+
+        if not isinstance(show, playback.ShowFile):
+            show = playback.ShowFile(show)
+        if show.frameBytes != self._pixelBytes:
+            raise ValueError("Show has %d bytes per frame, layout needs %d" %
+                (show.frameBytes, self._pixelBytes))
+        self.playback = playback.ShowPlayback(show, self.time, fade, loop)
+
+    def stopShow(self, fade=None):
+        """Crossfade from the current show back to the live effect."""
+        if self.playback:
+            self.playback.stop(self.time, fade)
+
+    def transitionTo(self, params, duration, names=None):
+        """Move our parameters smoothly to the values in another LightParameters object,
+           over 'duration' seconds, or right away if that's zero. Angles take the shorter
+           way around. Only the listed 'names' change, if given.
+
+           Changing a parameter directly while it's moving stops its transition, so a
+           performer's fader always wins.
+           """
+
+        if names is None:
+            names = LightParameters.names
+        for name in names:
+            value = getattr(params, name)
+            if duration <= 0:
+                self._transitions.pop(name, None)
+                setattr(self.params, name, value)
+                continue
+
+            start = getattr(self.params, name)
+            change = value - start
+            if name in LightParameters.angles:
+                change = (change + math.pi) % (2 * math.pi) - math.pi
+            self._transitions[name] = (start, change, value, self.time, duration, start)
+
+    def _updateTransitions(self):
+        for name, (start, change, end, startTime, duration, last) in self._transitions.items():
+            if getattr(self.params, name) != last:
+                # Changed by someone else
+                del self._transitions[name]
+                continue
+
+            t = (self.time - startTime) / duration
+            if t >= 1.0:
+                value = end
+                del self._transitions[name]
+            else:
+                t = max(0.0, t)
+                value = start + change * t * t * (3 - 2 * t)
+                self._transitions[name] = (start, change, end, startTime, duration, value)
+            setattr(self.params, name, value)
+
     def makeLightningBolt(self, x, y, z=0):
         # Make a single manually-positioned lightning bolt, with a short duration and no chaining.
         self.lightning.append(LightningBolt([x, y, z],
-            chainable=False, strength=1.0, falloff=20.0, fadeDuration=0.2, flickerDuration=0.1))
+            chainable=False, strength=1.0, falloff=20.0, fadeDuration=0.2, flickerDuration=0.1,
+            rng=self.random))
 
     def _updateLightning(self, dt):
         # Calculate lightning parameters for this frame
@@ -302,25 +536,26 @@ class LightController(object):
             # (Our renderer can handle any number, but we want to put a cap on this
             # to avoid an unbounded explosion in processing power required.)
 
-            r = random.random()
+            rng = self.random
+            r = rng.random()
             if r < self.params.lightning_new:
                 # Brand new lightning bolt. Put it at a random place in our model.
 
                 self.lightning.append(LightningBolt([
-                    random.uniform( self.model.pointMin[i], self.model.pointMax[i] )
+                    rng.uniform( self.model.pointMin[i], self.model.pointMax[i] )
                     for i in range(3)
-                    ]))
+                    ], rng=rng))
 
             elif r < self.params.lightning_chain and self.lightning:
                 # Chain from an existing lightning bolt. Use that bolt
                 # as the center of a normal distribution.
 
-                parent = random.choice(self.lightning)
+                parent = rng.choice(self.lightning)
                 if parent.chainable:
                     self.lightning.append(LightningBolt([
-                        random.gauss( parent.position[i], 0.5 )
+                        rng.gauss( parent.position[i], 0.5 )
                         for i in range(3)
-                        ]))
+                        ], rng=rng))
 
         # Render lightning bolts, and remove any that are expired
 
@@ -339,35 +574,103 @@ class LightController(object):
         return rendered
 
     def _generateColorBuffer(self):
-        # Generate a packed framebuffer with the background colors for each pixel, using a top/bottom gradient
-
-        # Normalized Z coordinate, from 0 to 1
-        z = (self.model.points[:,2] - self.model.pointMin[2]) / (self.model.pointMax[2] - self.model.pointMin[2])
-
-        # Color table indices
-        c = self.params.color_bottom + z * (self.params.color_top - self.params.color_bottom)
-
-        # Interpolated colors
-        colors = numpy.zeros(self.model.points.shape)
-        x = numpy.linspace(0.0, 1.0, colorTable.shape[0])
-        b = self.params.brightness / 255.0
-        for i in range(3):
-            colors[:,i] = b * numpy.interp(c, x, colorTable[:,i])
-        return colors.astype(numpy.float32).tostring()
+        # Generate a packed framebuffer with the background colors for each pixel, using a top/bottom
+        # gradient. Everything happens in place, in buffers we keep, so dragging a color or
+        # brightness fader doesn't allocate anything.
+
+        if self._colors is None:
+            count = len(self.model.points)
+            self._colors = numpy.empty((count, 3), dtype=numpy.float32)
+            self._colorPosition = numpy.empty(count, dtype=numpy.float32)
+            self._colorIndex = numpy.empty(count, dtype=numpy.intp)
+
+        # Color table indices, from the normalized Z coordinate
+        bottom = self.params.color_bottom * (colorLUTSize - 1)
+        top = self.params.color_top * (colorLUTSize - 1)
+        position = self._colorPosition
+        numpy.multiply(self.model.normalizedZ, top - bottom, out=position)
+        numpy.add(position, bottom + 0.5, out=position)
+        numpy.clip(position, 0, colorLUTSize - 1, out=position)
+        self._colorIndex[:] = position
+
+        # Colors, at this brightness
+        numpy.take(colorLUT, self._colorIndex, axis=0, out=self._colors)
+        numpy.multiply(self._colors, self.params.brightness, out=self._colors)
+        return self._colors
+
+    def _makeRenderKey(self, matrix, lightning, cbKey, noise):
+        # Everything the rendered pixels depend on, or None if we must render this frame.
+        # With zero brightness or zero contrast, the noise field is invisible, so the cloud
+        # matrix doesn't matter. This is what lets us idle cheaply between shows.
+
+        if lightning or self._lastLightningCount:
+            return None
+        if self.params.brightness == 0 or self.params.contrast == 0:
+            return (cbKey, self.params.contrast)
+        return (cbKey, self.params.contrast, noise, tuple(matrix))
 
     def _drawFrame(self, dt):
+        profiler = self.profiler
+
+        if self._transitions:
+            self._updateTransitions()
         self._updateTranslation(dt)
         matrix = self._makeCloudMatrix()
         lightning = self._updateLightning(dt)
+        if profiler:
+            profiler.mark('lightning')
+
+        # How much of a precomputed show to mix in, if we're playing one
+        mix = 0.0
+        if self.playback:
+            if self.playback.finished(self.time):
+                self.playback = None
+            else:
+                mix = self.playback.mix(self.time)
+
+        if mix == 1.0:
+            # Only the show is visible. Send its pixels straight from the memory-mapped
+            # file, between our header and DMX data, and skip rendering entirely.
+            self._renderKey = None
+            self._lastLightningCount = len(lightning)
+            self.opc.sendParts(self._frameHeader, self.playback.frame(self.time), self._frameDMX)
+            if profiler:
+                profiler.mark('send')
+            return
 
         # Update a cached color buffer if necessary
         cbKey = (self.params.color_top, self.params.color_bottom, self.params.brightness)
         if cbKey != self._colorBufferKey:
             self._colorBuffer = self._generateColorBuffer()
             self._colorBufferKey = cbKey
-
-        # Calculate our main cloud effect (Native code)
-        cloudPixels = cloud.render(self.model.packed, matrix, self._colorBuffer, self.params.contrast, lightning)
-
-        # Pack together our raw cloud pixels and NumPy DMX array, send it all off over OPC.
-        self.opc.putPixels(0, cloudPixels, self.dmx)
+        if profiler:
+            profiler.mark('color')
+
+        # Calculate our main cloud effect (Native code), directly into the frame after
+        # the OPC header. Skip this if the frame from last time is still valid.
+        octaves, persistence, lacunarity = noise = (
+            max(1, min(int(self.params.octaves), self.octaves)),
+            self.params.persistence, self.params.lacunarity)
+        renderKey = self._makeRenderKey(matrix, lightning, cbKey, noise)
+        if renderKey is None or renderKey != self._renderKey:
+            cloud.render_into(self._frame, self.opc.headerBytes,
+                self.model.packed, matrix, self._colorBuffer, self.params.contrast, lightning,
+                grid=self.model.grid, threshold=self.lightningThreshold or 0,
+                octaves=octaves, persistence=persistence, lacunarity=lacunarity)
+        else:
+            self.skippedRenders += 1
+        self._renderKey = renderKey
+        self._lastLightningCount = len(lightning)
+
+        if mix:
+            # Crossfading. The frame no longer holds the plain live effect.
+            playback.crossfade(self._pixels, self.playback.frame(self.time), mix)
+            self._renderKey = None
+        if profiler:
+            profiler.mark('render')
+
+        # The DMX array is already in place, so send it all off over OPC.
+        # Identical frames may be suppressed, depending on the OPC client's keepalive setting.
+        self.opc.sendFrame(self._frame)
+        if profiler:
+            profiler.mark('send')
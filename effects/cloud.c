@@ -36,15 +36,28 @@
  */
 
 #include <Python.h>
+#include <pthread.h>
+#include <stdint.h>
 #include "noise.h"
 
 #define ALWAYS_INLINE __attribute__((always_inline))
 
+// Upper limit on render threads, including the calling thread
+#define MAX_THREADS 16
 
-// We may expose these parameters to Python if needed, but so far there's no demand
-static const int NUM_OCTAVES = 4;
-static const float PERSISTENCE = 0.5;
-static const float LACUNARITY = 2.0;
+// Don't bother splitting the frame into strips smaller than this
+#define MIN_STRIP_PIXELS 64
+
+// Lightning bolts we can unpack without allocating memory
+#define LIGHTNING_STACK 32
+
+
+// Default fractal noise parameters; all of these can be changed per-call.
+// The octave count trades detail for speed, and is limited to MAX_OCTAVES.
+#define NUM_OCTAVES 4
+#define MAX_OCTAVES 8
+#define PERSISTENCE 0.5f
+#define LACUNARITY 2.0f
 
 
 typedef struct {
@@ -60,9 +73,32 @@ typedef struct {
     float contrast;
     int pixelCount;
     int lightningCount; 
-    Lightning_t *lightning;
+    const Lightning_t *lightning;
+    int vectorized;
+    int octaves;
+
+    // Per-octave frequency and amplitude, with amplitudes normalized to sum to 1.
+    // Calculated once per call from the octaves, persistence and lacunarity.
+    float freq[MAX_OCTAVES];
+    float amp[MAX_OCTAVES];
+
+    // Optional lightning culling. Each pixel has a grid cell, and each cell
+    // has a list of the lightning bolts which can reach it.
+    const int *cells;
+    const int *cellStart;
+    const int *cellBolts;
 } CloudArgs_t;
 
+typedef struct {
+    int dims[3];
+    float origin[3];
+    float cellSize;
+} Grid_t;
+
+
+// Use the batched noise kernel? See set_vectorized().
+static int useVectorNoise = NOISE_LANES > 1;
+
 
 inline static char ALWAYS_INLINE packChannel(float c)
 {
@@ -77,146 +113,903 @@ inline static char ALWAYS_INLINE packChannel(float c)
 }
 
 
-inline static void ALWAYS_INLINE render(CloudArgs_t args, char *pixels)
+inline static void ALWAYS_INLINE transform(const float *mat, const float *p,
+    float *x, float *y, float *z, float *w)
+{
+    /*
+     * Matrix multiply a model-space vector. (w0 assumed to be 1)
+     */
+
+    *x = mat[0] * p[0] + mat[4] * p[1] + mat[8] * p[2] + mat[12];
+    *y = mat[1] * p[0] + mat[5] * p[1] + mat[9] * p[2] + mat[13];
+    *z = mat[2] * p[0] + mat[6] * p[1] + mat[10] * p[2] + mat[14];
+    *w = mat[3] * p[0] + mat[7] * p[1] + mat[11] * p[2] + mat[15];
+}
+
+
+inline static void ALWAYS_INLINE addLightning(const Lightning_t *lt, const float *p, float *rgb)
+{
+    // Squared distance from lightning center
+    float xd = lt->center[0] - p[0];
+    float yd = lt->center[1] - p[1];
+    float zd = lt->center[2] - p[2];
+    float dist2 = xd*xd + yd*yd + zd*zd;
+
+    // Falloff calculation
+    float intensity = 1.0f / (1.0f + lt->falloff * dist2);
+
+    rgb[0] += intensity * lt->color[0];
+    rgb[1] += intensity * lt->color[1];
+    rgb[2] += intensity * lt->color[2];
+}
+
+
+inline static void ALWAYS_INLINE shade(const CloudArgs_t *args, int i, float noise, char *pixels)
+{
+    /*
+     * Color pixel 'i', given its noise value.
+     */
+
+    const float *p = args->model + i * 3;
+    const float *color = args->colors + i * 3;
+    char *pixel = pixels + i * 3;
+    float n = 1.0f + args->contrast * noise;
+    float rgb[3];
+
+    // Color interpolation
+    rgb[0] = color[0] * n;
+    rgb[1] = color[1] * n;
+    rgb[2] = color[2] * n;
+
+    // Sum the effects of each lightning object
+    if (args->cells) {
+        // Only the bolts which can reach this pixel's grid cell
+        int cell = args->cells[i];
+        const int *bolt = args->cellBolts + args->cellStart[cell];
+        const int *end = args->cellBolts + args->cellStart[cell + 1];
+
+        for (; bolt != end; bolt++) {
+            addLightning(&args->lightning[*bolt], p, rgb);
+        }
+    } else {
+        int ltCount = args->lightningCount;
+        const Lightning_t *ltPtr = args->lightning;
+
+        while (ltCount--) {
+            addLightning(ltPtr++, p, rgb);
+        }
+    }
+
+    pixel[0] = packChannel(rgb[0]);
+    pixel[1] = packChannel(rgb[1]);
+    pixel[2] = packChannel(rgb[2]);
+}
+
+
+inline static float ALWAYS_INLINE fbm(const CloudArgs_t *args,
+    float x, float y, float z, float w, const int octaves)
+{
+    /*
+     * Fractional brownian motion, using the per-octave tables in 'args'.
+     * 'octaves' is a constant wherever this is inlined, so the loop unrolls.
+     */
+
+    float total = 0;
+    int i;
+
+    for (i = 0; i < octaves; i++) {
+        float f = args->freq[i];
+        total += noise4(x * f, y * f, z * f, w * f) * args->amp[i];
+    }
+    return total;
+}
+
+#if NOISE_LANES > 1
+inline static vfloat ALWAYS_INLINE fbmBatch(const CloudArgs_t *args,
+    vfloat x, vfloat y, vfloat z, vfloat w, const int octaves)
+{
+    vfloat total = x * 0;
+    int i;
+
+    for (i = 0; i < octaves; i++) {
+        float f = args->freq[i];
+        total += noise4_batch(x * f, y * f, z * f, w * f) * args->amp[i];
+    }
+    return total;
+}
+#endif
+
+inline static void ALWAYS_INLINE render(CloudArgs_t args, char *pixels, const int octaves)
 {
     /*
      * Low-level rendering core. Uses parameters in 'args' (inlined), places results
-     * in the provided pixel buffer.
+     * in the provided pixel buffer. 'octaves' must be a compile-time constant; see
+     * renderOctaves().
+     *
+     * When vectorized, the noise field is sampled NOISE_LANES pixels at a time.
+     * Any leftover pixels at the end use the scalar noise function.
      */
 
-    while (args.pixelCount--) {
-        float x0, y0, z0, x, y, z, w, r, g, b, n;
-        int ltCount = args.lightningCount;
-        Lightning_t *ltPtr = args.lightning;
+    int i = 0;
+
+#if NOISE_LANES > 1
+    if (args.vectorized) {
+        for (; i + NOISE_LANES <= args.pixelCount; i += NOISE_LANES) {
+            vfloat x, y, z, w, n;
+            int lane;
+
+            for (lane = 0; lane < NOISE_LANES; lane++) {
+                float xl, yl, zl, wl;
+                transform(args.mat, args.model + (i + lane) * 3, &xl, &yl, &zl, &wl);
+                x[lane] = xl;
+                y[lane] = yl;
+                z[lane] = zl;
+                w[lane] = wl;
+            }
+
+            // Fractional brownian motion
+            n = fbmBatch(&args, x, y, z, w, octaves);
+
+            for (lane = 0; lane < NOISE_LANES; lane++) {
+                shade(&args, i + lane, n[lane], pixels);
+            }
+        }
+    }
+#endif
 
-        // Model-space vector. (w0 assumed to be 1)
-        x0 = args.model[0];
-        y0 = args.model[1];
-        z0 = args.model[2];
-        args.model += 3;
+    for (; i < args.pixelCount; i++) {
+        float x, y, z, w;
 
-        // Matrix multiply
-        x = args.mat[0] * x0 + args.mat[4] * y0 + args.mat[8] * z0 + args.mat[12];
-        y = args.mat[1] * x0 + args.mat[5] * y0 + args.mat[9] * z0 + args.mat[13];
-        z = args.mat[2] * x0 + args.mat[6] * y0 + args.mat[10] * z0 + args.mat[14];
-        w = args.mat[3] * x0 + args.mat[7] * y0 + args.mat[11] * z0 + args.mat[15];
+        transform(args.mat, args.model + i * 3, &x, &y, &z, &w);
 
         // Fractional brownian motion
-        n = 1.0f + args.contrast * fbm_noise4(x, y, z, w, NUM_OCTAVES, PERSISTENCE, LACUNARITY);
+        shade(&args, i, fbm(&args, x, y, z, w, octaves), pixels);
+    }
+}
+
+static void renderOctaves(const CloudArgs_t *args, char *pixels)
+{
+    /*
+     * One specialized copy of render() per octave count, so each octave dropped
+     * saves its full share of the noise work rather than a loop iteration's worth.
+     */
+
+    switch (args->octaves) {
+        case 1: render(*args, pixels, 1); break;
+        case 2: render(*args, pixels, 2); break;
+        case 3: render(*args, pixels, 3); break;
+        case 4: render(*args, pixels, 4); break;
+        case 5: render(*args, pixels, 5); break;
+        case 6: render(*args, pixels, 6); break;
+        case 7: render(*args, pixels, 7); break;
+        case 8: render(*args, pixels, 8); break;
+    }
+}
 
-        // Color interpolation
-        r = args.colors[0] * n;
-        g = args.colors[1] * n;
-        b = args.colors[2] * n;
-        args.colors += 3;
 
-        // Sum the effects of each lightning object
-        while (ltCount--) {
+/*
+ * Persistent pool of render threads.
+ *
+ * The frame is split into contiguous strips of pixels. The calling thread always
+ * renders strip 0, and each worker thread renders one additional strip. Every pixel
+ * is computed exactly as it would be in the single-threaded case, so the output is
+ * bit-identical regardless of the number of threads.
+ *
+ * 'frameLock' serializes whole frames and pool resizes, 'lock' protects the rest.
+ */
+
+typedef struct {
+    pthread_mutex_t frameLock;
+    pthread_mutex_t lock;
+    pthread_cond_t start;
+    pthread_cond_t done;
+    pthread_t workers[MAX_THREADS];
+    int workerCount;
+    int quit;
+    int generation;         // Incremented once per dispatched frame
+    int spawnGeneration;    // Generation at the time the workers were started
+    int pending;            // Worker strips not yet finished
+    int strips;
+    CloudArgs_t args;
+    char *pixels;
+} RenderPool_t;
+
+static RenderPool_t pool = {
+    PTHREAD_MUTEX_INITIALIZER,
+    PTHREAD_MUTEX_INITIALIZER,
+    PTHREAD_COND_INITIALIZER,
+    PTHREAD_COND_INITIALIZER,
+};
 
-            // Squared distance from lightning center
-            float xd = ltPtr->center[0] - x0;
-            float yd = ltPtr->center[1] - y0;
-            float zd = ltPtr->center[2] - z0;
-            float dist2 = xd*xd + yd*yd + zd*zd;
 
-            // Falloff calculation
-            float intensity = 1.0f / (1.0f + ltPtr->falloff * dist2);
+static void renderStrip(const CloudArgs_t *args, char *pixels, int strip, int strips)
+{
+    /*
+     * Render one strip of a frame split 'strips' ways. Strip boundaries are aligned
+     * to NOISE_LANES, so every pixel takes the same noise path as it would in a
+     * single-threaded render.
+     */
 
-            r += intensity * ltPtr->color[0];
-            g += intensity * ltPtr->color[1];
-            b += intensity * ltPtr->color[2];
+    CloudArgs_t sa = *args;
+    int first = (int) ((long long) args->pixelCount * strip / strips) / NOISE_LANES * NOISE_LANES;
+    int last = strip + 1 == strips ? args->pixelCount :
+        (int) ((long long) args->pixelCount * (strip + 1) / strips) / NOISE_LANES * NOISE_LANES;
 
-            ltPtr++;
+    sa.model += first * 3;
+    sa.colors += first * 3;
+    if (sa.cells) {
+        sa.cells += first;
+    }
+    sa.pixelCount = last - first;
+    renderOctaves(&sa, pixels + first * 3);
+}
+
+
+static void *poolWorker(void *arg)
+{
+    int strip = (int) (intptr_t) arg;
+    int seen;
+
+    pthread_mutex_lock(&pool.lock);
+    seen = pool.spawnGeneration;
+
+    for (;;) {
+        CloudArgs_t args;
+        char *pixels;
+        int strips;
+
+        while (pool.generation == seen && !pool.quit) {
+            pthread_cond_wait(&pool.start, &pool.lock);
+        }
+        if (pool.quit) {
+            break;
+        }
+
+        seen = pool.generation;
+        args = pool.args;
+        pixels = pool.pixels;
+        strips = pool.strips;
+        pthread_mutex_unlock(&pool.lock);
+
+        // Small frames are split fewer ways than we have workers. The rest sit
+        // this frame out, but still check in, so the frame's 'pending' count is exact.
+        if (strip < strips) {
+            renderStrip(&args, pixels, strip, strips);
         }
 
-        pixels[0] = packChannel(r);
-        pixels[1] = packChannel(g);
-        pixels[2] = packChannel(b);
-        pixels += 3;
+        pthread_mutex_lock(&pool.lock);
+        if (--pool.pending == 0) {
+            pthread_cond_signal(&pool.done);
+        }
     }
+
+    pthread_mutex_unlock(&pool.lock);
+    return NULL;
 }
 
 
-static PyObject* py_render(PyObject* self, PyObject* args)
+static int resizePool(int threadCount)
 {
     /*
-     * Python argument parsing and return formatting for render()
+     * Stop all existing workers and start (threadCount - 1) new ones.
+     * Must be called with the GIL released. Returns the number of workers started.
+     */
+
+    int i;
+
+    pthread_mutex_lock(&pool.frameLock);
+
+    pthread_mutex_lock(&pool.lock);
+    pool.quit = 1;
+    pthread_cond_broadcast(&pool.start);
+    pthread_mutex_unlock(&pool.lock);
+
+    for (i = 0; i < pool.workerCount; ++i) {
+        pthread_join(pool.workers[i], NULL);
+    }
+
+    pthread_mutex_lock(&pool.lock);
+    pool.quit = 0;
+    pool.workerCount = 0;
+    pool.spawnGeneration = pool.generation;
+    pthread_mutex_unlock(&pool.lock);
+
+    for (i = 0; i < threadCount - 1; ++i) {
+        if (pthread_create(&pool.workers[i], NULL, poolWorker, (void*) (intptr_t) (i + 1))) {
+            break;
+        }
+        pool.workerCount++;
+    }
+
+    pthread_mutex_unlock(&pool.frameLock);
+    return pool.workerCount;
+}
+
+
+static void renderParallel(const CloudArgs_t *args, char *pixels)
+{
+    /*
+     * Render a full frame, using the thread pool if it's worthwhile.
+     * Must be called with the GIL released.
      */
 
+    int strips;
+
+    pthread_mutex_lock(&pool.frameLock);
+
+    strips = pool.workerCount + 1;
+    if (strips > args->pixelCount / MIN_STRIP_PIXELS) {
+        strips = args->pixelCount / MIN_STRIP_PIXELS;
+    }
+
+    if (strips <= 1) {
+        renderOctaves(args, pixels);
+
+    } else {
+        pthread_mutex_lock(&pool.lock);
+        pool.args = *args;
+        pool.pixels = pixels;
+        pool.strips = strips;
+        pool.pending = pool.workerCount;
+        pool.generation++;
+        pthread_cond_broadcast(&pool.start);
+        pthread_mutex_unlock(&pool.lock);
+
+        renderStrip(args, pixels, 0, strips);
+
+        pthread_mutex_lock(&pool.lock);
+        while (pool.pending) {
+            pthread_cond_wait(&pool.done, &pool.lock);
+        }
+        pthread_mutex_unlock(&pool.lock);
+    }
+
+    pthread_mutex_unlock(&pool.frameLock);
+}
+
+
+/*
+ * Argument handling shared by render() and render_into().
+ *
+ * The matrix and lightning arguments may be either Python sequences or buffers of
+ * packed 32-bit floats. Packed buffers are used in place, so a caller that reuses
+ * its own buffers every frame doesn't cause any allocation here. Lightning given as
+ * a sequence is parsed into storage on the stack, or on the heap for big storms.
+ */
+
+typedef struct {
     CloudArgs_t ca;
-    int i, modelBytes, colorsBytes;
-    Py_ssize_t tmp;
-    PyObject *lightningObj;
-    char *pixels;
-    PyObject *result = NULL;
+    Py_buffer model;
+    Py_buffer colors;
+    Py_buffer lightningBuffer;
+    Lightning_t lightningStack[LIGHTNING_STACK];
+    Lightning_t *lightningHeap;
+    Py_buffer cellsBuffer;
+    int *binHeap;
+} RenderCall_t;
 
-    if (!PyArg_ParseTuple(args, "t#(ffffffffffffffff)t#fO:render",
-        &ca.model, &modelBytes,
-        &ca.mat[0],  &ca.mat[1],  &ca.mat[2],  &ca.mat[3],  
-        &ca.mat[4],  &ca.mat[5],  &ca.mat[6],  &ca.mat[7],
-        &ca.mat[8],  &ca.mat[9],  &ca.mat[10], &ca.mat[11], 
-        &ca.mat[12], &ca.mat[13], &ca.mat[14], &ca.mat[15],
-        &ca.colors, &colorsBytes,
-        &ca.contrast,
-        &lightningObj)) {
-        return NULL;
+
+static int parseMatrix(PyObject *obj, float *mat)
+{
+    PyObject *seq;
+    int i;
+
+    if (!PyList_Check(obj) && !PyTuple_Check(obj)) {
+        const void *buf;
+        Py_ssize_t len;
+
+        if (PyObject_AsReadBuffer(obj, &buf, &len) == 0) {
+            if (len != 16 * sizeof(float)) {
+                PyErr_SetString(PyExc_ValueError, "Matrix buffer must hold 16 packed floats");
+                return -1;
+            }
+            memcpy(mat, buf, 16 * sizeof(float));
+            return 0;
+        }
+        PyErr_Clear();
     }
 
-    if (modelBytes % 12) {
-        PyErr_SetString(PyExc_ValueError, "Model string is not a multiple of 12 bytes long");
-        return NULL;
+    seq = PySequence_Fast(obj, "Matrix is not a sequence or buffer object");
+    if (!seq) {
+        return -1;
+    }
+    if (PySequence_Fast_GET_SIZE(seq) != 16) {
+        Py_DECREF(seq);
+        PyErr_SetString(PyExc_ValueError, "Matrix must have 16 elements");
+        return -1;
     }
-    ca.pixelCount = modelBytes / 12;
+    for (i = 0; i < 16; ++i) {
+        mat[i] = (float) PyFloat_AsDouble(PySequence_Fast_GET_ITEM(seq, i));
+    }
+    Py_DECREF(seq);
 
-    if (modelBytes != colorsBytes) {
-        PyErr_SetString(PyExc_ValueError, "Colors string length does not match model length");
-        return NULL;
+    return PyErr_Occurred() ? -1 : 0;
+}
+
+
+static Lightning_t *lightningStorage(RenderCall_t *rc, int count)
+{
+    if (count <= LIGHTNING_STACK) {
+        return rc->lightningStack;
+    }
+    rc->lightningHeap = PyMem_Malloc(count * sizeof(Lightning_t));
+    if (!rc->lightningHeap) {
+        PyErr_NoMemory();
     }
+    return rc->lightningHeap;
+}
+
 
-    if (!PySequence_Check(lightningObj)) {
+static int parseLightning(PyObject *obj, RenderCall_t *rc)
+{
+    CloudArgs_t *ca = &rc->ca;
+    Lightning_t *storage;
+    int i;
+
+    if (!PyList_Check(obj) && !PyTuple_Check(obj)) {
+        // Packed buffer. We hold on to it until endRender(), since it's used without the GIL.
+
+        if (PyObject_GetBuffer(obj, &rc->lightningBuffer, PyBUF_SIMPLE) == 0) {
+            if (rc->lightningBuffer.len % sizeof(Lightning_t)) {
+                PyErr_SetString(PyExc_ValueError, "Lightning buffer is not a multiple of 7 packed floats");
+                return -1;
+            }
+            ca->lightningCount = (int) (rc->lightningBuffer.len / sizeof(Lightning_t));
+
+            if (((uintptr_t) rc->lightningBuffer.buf) % sizeof(float) == 0) {
+                ca->lightning = (const Lightning_t*) rc->lightningBuffer.buf;
+                return 0;
+            }
+
+            // Unaligned, make a copy
+            storage = lightningStorage(rc, ca->lightningCount);
+            if (!storage) {
+                return -1;
+            }
+            memcpy(storage, rc->lightningBuffer.buf, ca->lightningCount * sizeof(Lightning_t));
+            ca->lightning = storage;
+            return 0;
+        }
+        PyErr_Clear();
+    }
+
+    if (!PySequence_Check(obj)) {
         PyErr_SetString(PyExc_TypeError, "Lightning is not a sequence object");
-        return NULL;
+        return -1;
     }
-    ca.lightningCount = (int) PySequence_Length(lightningObj);
+    ca->lightningCount = (int) PySequence_Length(obj);
 
-    ca.lightning = PyMem_Malloc(ca.lightningCount * sizeof ca.lightning[0]);
-    if (!ca.lightning) {
-        return PyErr_NoMemory();
+    storage = lightningStorage(rc, ca->lightningCount);
+    if (!storage) {
+        return -1;
     }
+    ca->lightning = storage;
 
-    for (i = 0; i < ca.lightningCount; ++i) {
-        PyObject *item = PySequence_GetItem(lightningObj, i);
-        Lightning_t *lt = &ca.lightning[i];
+    for (i = 0; i < ca->lightningCount; ++i) {
+        PyObject *item = PySequence_GetItem(obj, i);
+        Lightning_t *lt = &storage[i];
 
-        if (!PyArg_Parse(item, "(fffffff)",
+        if (!item || !PyArg_Parse(item, "(fffffff)",
             &lt->center[0], &lt->center[1], &lt->center[2],
             &lt->color[0], &lt->color[1], &lt->color[2],
             &lt->falloff)) {
-            Py_DECREF(item);
-            PyMem_Free(ca.lightning);
-            return NULL;
+            Py_XDECREF(item);
+            return -1;
         }
         Py_DECREF(item);
     }
 
-    result = PyBuffer_New(ca.pixelCount * 3);
-    if (result) {
-        PyObject_AsWriteBuffer(result, (void**) &pixels, &tmp);
-        render(ca, pixels);
+    return 0;
+}
+
+
+inline static int cellRange(const Grid_t *grid, int axis, float center, float radius, int *lo, int *hi)
+{
+    /*
+     * Range of grid cells along one axis within 'radius' of 'center'. Returns 0 if none.
+     */
+
+    float first = floorf((center - radius - grid->origin[axis]) / grid->cellSize);
+    float last = floorf((center + radius - grid->origin[axis]) / grid->cellSize);
+
+    if (last < 0 || first >= grid->dims[axis]) {
+        return 0;
+    }
+    *lo = first < 0 ? 0 : (int) first;
+    *hi = last >= grid->dims[axis] ? grid->dims[axis] - 1 : (int) last;
+    return 1;
+}
+
+
+static int boltCells(const Grid_t *grid, const Lightning_t *lt, float threshold, int *lo, int *hi)
+{
+    /*
+     * Find the box of grid cells where this bolt can contribute more than 'threshold'
+     * to any color channel. Returns 0 if it can't contribute anywhere.
+     *
+     * Intensity is 1 / (1 + falloff * dist2), so solve for the distance where
+     * intensity times the brightest channel drops to the threshold.
+     */
+
+    float peak = lt->color[0];
+    float radius;
+    int axis;
+
+    if (lt->color[1] > peak) peak = lt->color[1];
+    if (lt->color[2] > peak) peak = lt->color[2];
+    if (peak <= threshold) {
+        return 0;
+    }
+
+    if (lt->falloff > 0) {
+        radius = sqrtf((peak / threshold - 1.0f) / lt->falloff);
+    } else {
+        radius = FLT_MAX;
+    }
+
+    for (axis = 0; axis < 3; ++axis) {
+        if (!cellRange(grid, axis, lt->center[axis], radius, &lo[axis], &hi[axis])) {
+            return 0;
+        }
+    }
+    return 1;
+}
+
+
+static int binLightning(RenderCall_t *rc, const Grid_t *grid, float threshold)
+{
+    /*
+     * Build per-cell lists of lightning bolts, preserving bolt order so the sum
+     * for each pixel is computed the same way as without culling.
+     */
+
+    CloudArgs_t *ca = &rc->ca;
+    int cellCount = grid->dims[0] * grid->dims[1] * grid->dims[2];
+    int total = 0;
+    int *cellStart, *cursor, *cellBolts;
+    int b, x, y, z, lo[3], hi[3];
+
+    for (b = 0; b < ca->lightningCount; ++b) {
+        if (boltCells(grid, &ca->lightning[b], threshold, lo, hi)) {
+            total += (hi[0] - lo[0] + 1) * (hi[1] - lo[1] + 1) * (hi[2] - lo[2] + 1);
+        }
+    }
+
+    rc->binHeap = PyMem_Malloc((2 * cellCount + 1 + total) * sizeof(int));
+    if (!rc->binHeap) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    cellStart = rc->binHeap;
+    cursor = cellStart + cellCount + 1;
+    cellBolts = cursor + cellCount;
+    memset(cellStart, 0, (cellCount + 1) * sizeof(int));
+
+    // Count bolts per cell, then convert counts to starting offsets
+
+    for (b = 0; b < ca->lightningCount; ++b) {
+        if (boltCells(grid, &ca->lightning[b], threshold, lo, hi)) {
+            for (z = lo[2]; z <= hi[2]; ++z)
+                for (y = lo[1]; y <= hi[1]; ++y)
+                    for (x = lo[0]; x <= hi[0]; ++x)
+                        cellStart[(z * grid->dims[1] + y) * grid->dims[0] + x + 1]++;
+        }
+    }
+    for (x = 0; x < cellCount; ++x) {
+        cellStart[x + 1] += cellStart[x];
+        cursor[x] = cellStart[x];
+    }
+
+    for (b = 0; b < ca->lightningCount; ++b) {
+        if (boltCells(grid, &ca->lightning[b], threshold, lo, hi)) {
+            for (z = lo[2]; z <= hi[2]; ++z)
+                for (y = lo[1]; y <= hi[1]; ++y)
+                    for (x = lo[0]; x <= hi[0]; ++x)
+                        cellBolts[cursor[(z * grid->dims[1] + y) * grid->dims[0] + x]++] = b;
+        }
+    }
+
+    ca->cellStart = cellStart;
+    ca->cellBolts = cellBolts;
+    return 0;
+}
+
+
+static int parseGrid(PyObject *obj, RenderCall_t *rc, Grid_t *grid)
+{
+    /*
+     * Grid tuple is (cells, xDim, yDim, zDim, xOrigin, yOrigin, zOrigin, cellSize), where
+     * 'cells' holds a packed 32-bit cell index for each pixel.
+     */
+
+    CloudArgs_t *ca = &rc->ca;
+    int cellCount, i;
+
+    if (!PyArg_ParseTuple(obj, "s*iiiffff;Grid must be a (cells, xDim, yDim, zDim, x, y, z, cellSize) tuple",
+        &rc->cellsBuffer, &grid->dims[0], &grid->dims[1], &grid->dims[2],
+        &grid->origin[0], &grid->origin[1], &grid->origin[2], &grid->cellSize)) {
+        return -1;
+    }
+    ca->cells = rc->cellsBuffer.buf;
+
+    if (rc->cellsBuffer.len != ca->pixelCount * sizeof(int)) {
+        PyErr_SetString(PyExc_ValueError, "Grid cells length does not match model length");
+        return -1;
+    }
+    if (grid->dims[0] < 1 || grid->dims[1] < 1 || grid->dims[2] < 1 || !(grid->cellSize > 0)) {
+        PyErr_SetString(PyExc_ValueError, "Grid dimensions must be positive");
+        return -1;
+    }
+
+    cellCount = grid->dims[0] * grid->dims[1] * grid->dims[2];
+    for (i = 0; i < ca->pixelCount; ++i) {
+        if (ca->cells[i] < 0 || ca->cells[i] >= cellCount) {
+            PyErr_SetString(PyExc_ValueError, "Grid cell index out of range");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+
+static int prepareRender(RenderCall_t *rc, PyObject *matrixObj, PyObject *lightningObj,
+    PyObject *gridObj, float threshold, float persistence, float lacunarity)
+{
+    /*
+     * Validate and unpack everything besides the model and color buffers, which
+     * have already been parsed. On failure, endRender() must still be called.
+     */
+
+    CloudArgs_t *ca = &rc->ca;
+
+    ca->model = rc->model.buf;
+    ca->colors = rc->colors.buf;
+    ca->vectorized = useVectorNoise;
+
+    if (rc->model.len % 12) {
+        PyErr_SetString(PyExc_ValueError, "Model string is not a multiple of 12 bytes long");
+        return -1;
+    }
+    ca->pixelCount = (int) (rc->model.len / 12);
+
+    if (rc->model.len != rc->colors.len) {
+        PyErr_SetString(PyExc_ValueError, "Colors string length does not match model length");
+        return -1;
+    }
+
+    if (ca->octaves < 1 || ca->octaves > MAX_OCTAVES) {
+        PyErr_Format(PyExc_ValueError, "Octaves must be between 1 and %d", MAX_OCTAVES);
+        return -1;
+    } else {
+        float freq = 1.0f, amp = 1.0f, total = 0.0f;
+        int i;
+
+        for (i = 0; i < ca->octaves; i++) {
+            ca->freq[i] = freq;
+            ca->amp[i] = amp;
+            total += amp;
+            freq *= lacunarity;
+            amp *= persistence;
+        }
+        if (!(total > 0)) {
+            PyErr_SetString(PyExc_ValueError, "Persistence must be positive");
+            return -1;
+        }
+        for (i = 0; i < ca->octaves; i++) {
+            ca->amp[i] /= total;
+        }
     }
 
-    PyMem_Free(ca.lightning);
+    if (parseMatrix(matrixObj, ca->mat) < 0) {
+        return -1;
+    }
+    if (parseLightning(lightningObj, rc) < 0) {
+        return -1;
+    }
+
+    if (gridObj && gridObj != Py_None && threshold > 0) {
+        Grid_t grid;
+
+        if (parseGrid(gridObj, rc, &grid) < 0) {
+            return -1;
+        }
+        return binLightning(rc, &grid, threshold);
+    }
+    return 0;
+}
+
+
+static void endRender(RenderCall_t *rc)
+{
+    PyBuffer_Release(&rc->model);
+    PyBuffer_Release(&rc->colors);
+    if (rc->lightningBuffer.obj) {
+        PyBuffer_Release(&rc->lightningBuffer);
+    }
+    if (rc->lightningHeap) {
+        PyMem_Free(rc->lightningHeap);
+    }
+    if (rc->cellsBuffer.obj) {
+        PyBuffer_Release(&rc->cellsBuffer);
+    }
+    if (rc->binHeap) {
+        PyMem_Free(rc->binHeap);
+    }
+}
+
+
+static PyObject* py_render(PyObject* self, PyObject* args, PyObject* kw)
+{
+    /*
+     * Python argument parsing and return formatting for render()
+     */
+
+    static char *kwlist[] = { "model", "matrix", "colors", "contrast", "lightning",
+        "grid", "threshold", "octaves", "persistence", "lacunarity", NULL };
+
+    RenderCall_t rc;
+    PyObject *matrixObj, *lightningObj, *gridObj = NULL;
+    float threshold = 0, persistence = PERSISTENCE, lacunarity = LACUNARITY;
+    Py_ssize_t tmp;
+    char *pixels;
+    PyObject *result = NULL;
+
+    memset(&rc, 0, sizeof rc);
+    rc.ca.octaves = NUM_OCTAVES;
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "s*Os*fO|Ofiff:render", kwlist,
+        &rc.model, &matrixObj, &rc.colors, &rc.ca.contrast, &lightningObj, &gridObj, &threshold,
+        &rc.ca.octaves, &persistence, &lacunarity)) {
+        return NULL;
+    }
+
+    if (prepareRender(&rc, matrixObj, lightningObj, gridObj, threshold,
+        persistence, lacunarity) == 0) {
+        result = PyBuffer_New(rc.ca.pixelCount * 3);
+        if (result) {
+            PyObject_AsWriteBuffer(result, (void**) &pixels, &tmp);
+            Py_BEGIN_ALLOW_THREADS
+            renderParallel(&rc.ca, pixels);
+            Py_END_ALLOW_THREADS
+        }
+    }
+
+    endRender(&rc);
     return result;
 }
 
+
+static PyObject* py_render_into(PyObject* self, PyObject* args, PyObject* kw)
+{
+    /*
+     * Python argument parsing for render_into()
+     */
+
+    static char *kwlist[] = { "out", "offset", "model", "matrix", "colors", "contrast", "lightning",
+        "grid", "threshold", "octaves", "persistence", "lacunarity", NULL };
+
+    RenderCall_t rc;
+    Py_buffer out;
+    int offset;
+    PyObject *matrixObj, *lightningObj, *gridObj = NULL;
+    float threshold = 0, persistence = PERSISTENCE, lacunarity = LACUNARITY;
+    PyObject *result = NULL;
+
+    memset(&rc, 0, sizeof rc);
+    rc.ca.octaves = NUM_OCTAVES;
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "w*is*Os*fO|Ofiff:render_into", kwlist,
+        &out, &offset, &rc.model, &matrixObj, &rc.colors, &rc.ca.contrast, &lightningObj,
+        &gridObj, &threshold, &rc.ca.octaves, &persistence, &lacunarity)) {
+        return NULL;
+    }
+
+    if (prepareRender(&rc, matrixObj, lightningObj, gridObj, threshold,
+        persistence, lacunarity) == 0) {
+        if (offset < 0 || offset + rc.ca.pixelCount * 3 > out.len) {
+            PyErr_SetString(PyExc_ValueError, "Output buffer is too small");
+        } else {
+            Py_BEGIN_ALLOW_THREADS
+            renderParallel(&rc.ca, (char*) out.buf + offset);
+            Py_END_ALLOW_THREADS
+            Py_INCREF(Py_None);
+            result = Py_None;
+        }
+    }
+
+    PyBuffer_Release(&out);
+    endRender(&rc);
+    return result;
+}
+
+
+static PyObject* py_set_threads(PyObject* self, PyObject* args)
+{
+    int threadCount, started;
+
+    if (!PyArg_ParseTuple(args, "i:set_threads", &threadCount)) {
+        return NULL;
+    }
+    if (threadCount < 1 || threadCount > MAX_THREADS) {
+        PyErr_Format(PyExc_ValueError, "Thread count must be between 1 and %d", MAX_THREADS);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    started = resizePool(threadCount);
+    Py_END_ALLOW_THREADS
+
+    if (started != threadCount - 1) {
+        PyErr_SetString(PyExc_RuntimeError, "Failed to start render threads");
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject* py_get_threads(PyObject* self, PyObject* args)
+{
+    return PyInt_FromLong(pool.workerCount + 1);
+}
+
+static PyObject* py_set_vectorized(PyObject* self, PyObject* args)
+{
+    PyObject *enabled;
+
+    if (!PyArg_ParseTuple(args, "O:set_vectorized", &enabled)) {
+        return NULL;
+    }
+    useVectorNoise = NOISE_LANES > 1 && PyObject_IsTrue(enabled);
+    Py_RETURN_NONE;
+}
+
+static PyObject* py_memory_barrier(PyObject* self, PyObject* args)
+{
+    __sync_synchronize();
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef cloud_functions[] = {
-    { "render", (PyCFunction)py_render, METH_VARARGS,
-        "render(model, matrix, colors, contrast, lightning) -- return rendered RGB pixels, as a string\n\n"
+    { "render", (PyCFunction)py_render, METH_VARARGS | METH_KEYWORDS,
+        "render(model, matrix, colors, contrast, lightning, grid=None, threshold=0,\n"
+        "       octaves=4, persistence=0.5, lacunarity=2.0) -- "
+        "return rendered RGB pixels, as a string\n\n"
         "model -- (x,y,z) coordinates for each LED, represented as a string of packed 32-bit floats\n"
         "matrix -- List of 16 floats; a column-major 4x4 matrix which model coordinates are multiplied by\n"
         "colors -- (r,g,b) base color for each pixel, as a string of packed 32-bit floats\n"
         "contrast -- Proportion of base color to modulate with noise field\n"
-        "lightning -- List of lightning points, in model space. Each one is an (x, y, z, r, g, b, falloff) tuple\n"
+        "lightning -- List of lightning points, in model space. Each one is an (x, y, z, r, g, b, falloff) tuple\n\n"
+        "grid -- Optional (cells, xDim, yDim, zDim, x, y, z, cellSize) tuple. 'cells' is a packed\n"
+        "    32-bit index for each LED into a uniform grid with its minimum corner at (x, y, z)\n"
+        "threshold -- With a grid, skip lightning in grid cells where it can't add more than this\n"
+        "octaves -- Number of noise octaves, from 1 to MAX_OCTAVES. Fewer is faster but less detailed\n"
+        "persistence -- Amplitude of each noise octave relative to the one before\n"
+        "lacunarity -- Frequency of each noise octave relative to the one before\n\n"
+        "matrix and lightning may also be buffers of packed 32-bit floats, 7 per lightning point.\n"
+        "The GIL is released while rendering. See set_threads().\n"
+    },
+    { "render_into", (PyCFunction)py_render_into, METH_VARARGS | METH_KEYWORDS,
+        "render_into(out, offset, model, matrix, colors, contrast, lightning, grid=None, threshold=0,\n"
+        "            octaves=4, persistence=0.5, lacunarity=2.0) -- "
+        "render into a buffer\n\n"
+        "Like render(), but writes RGB pixels into the writable buffer 'out' starting at byte 'offset'.\n"
+        "Typically 'out' is a preallocated bytearray holding a whole OPC message, with its\n"
+        "4-byte header in front. Nothing is allocated when matrix and lightning are packed buffers.\n"
+    },
+    { "set_threads", (PyCFunction)py_set_threads, METH_VARARGS,
+        "set_threads(count) -- render using 'count' native threads, including the calling thread\n\n"
+        "Worker threads are persistent, and each one renders a contiguous strip of pixels.\n"
+        "Output is identical for any thread count. The default is 1, no worker threads.\n"
+    },
+    { "get_threads", (PyCFunction)py_get_threads, METH_NOARGS,
+        "get_threads() -- return the number of render threads, including the calling thread\n"
+    },
+    { "set_vectorized", (PyCFunction)py_set_vectorized, METH_VARARGS,
+        "set_vectorized(enabled) -- sample noise NOISE_LANES pixels at a time, using SIMD instructions\n\n"
+        "Enabled by default when the module was built with a vector instruction set.\n"
+        "Results match the scalar path to within floating point rounding.\n"
+    },
+    { "memory_barrier", (PyCFunction)py_memory_barrier, METH_NOARGS,
+        "memory_barrier() -- full hardware memory barrier\n\n"
+        "Memory accesses before the call are seen by other CPUs before any after it. For data\n"
+        "shared between processes without locks, such as effects.remote.ParameterBlock.\n"
     },
     {NULL}
 };
@@ -225,5 +1018,10 @@ PyDoc_STRVAR(module_doc, "Native-code cloud lighting effect core");
 
 void initcloud(void)
 {
-    Py_InitModule3("cloud", cloud_functions, module_doc);
+    PyObject *m = Py_InitModule3("cloud", cloud_functions, module_doc);
+    if (m) {
+        PyModule_AddIntConstant(m, "NOISE_LANES", NOISE_LANES);
+        PyModule_AddIntConstant(m, "NUM_OCTAVES", NUM_OCTAVES);
+        PyModule_AddIntConstant(m, "MAX_OCTAVES", MAX_OCTAVES);
+    }
 }
\ No newline at end of file
@@ -20,26 +20,109 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
    
+import collections
 import json
 import numpy
 import os
 import socket
 import struct
+import sys
+import threading
 import time
 
+# Tells the kernel more of the same message follows, so a header and body sent with
+# separate calls still leave in one packet. Python 2 doesn't define it; this is Linux's value.
+MSG_MORE = getattr(socket, 'MSG_MORE', sys.platform.startswith('linux') and 0x8000 or 0)
+
+
+def parseAddress(server):
+    """Parse an OPC server address, returning a (family, address) tuple for socket.connect().
+       Addresses are either "host:port" for TCP, or "unix:/path/to/socket" for a
+       Unix domain socket on the local machine.
+       """
+
+    if server.startswith('unix:'):
+        return socket.AF_UNIX, server[len('unix:'):]
+    host, port = server.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
 
 class FastOPC(object):
     """High-performance Open Pixel Control client, using Numeric Python.
        By default, assumes the OPC server is running on localhost. This may be overridden
        with the OPC_SERVER environment variable, or the 'server' keyword argument.
+
+       The server may be given as "host:port", or as "unix:/path/to/socket" to skip the
+       TCP stack when the OPC server is on the same machine and can listen on a Unix socket.
+
+       If 'keepalive' is set, sendFrame() skips frames identical to the last one sent,
+       but still sends at least one frame every 'keepalive' seconds.
        """
 
-    def __init__(self, server=None):
+    # Size of the header at the front of every OPC message
+    headerBytes = 4
+
+    # Seconds a connect or send may block before we give up on the server
+    sendTimeout = 1.0
+
+    def __init__(self, server=None, keepalive=None):
         self.server = server or os.getenv('OPC_SERVER') or '127.0.0.1:7890'
-        self.host, port = self.server.split(':')
-        self.port = int(port)
+        self.family, self.address = parseAddress(self.server)
+        self.socket = None
+
+        self.keepalive = keepalive
+        self.suppressed = 0
+        self._lastFrame = bytearray()
+        self._lastFrameTime = 0
+
+
+    def _connect(self):
+        """Try to connect to the OPC server. Returns True on success."""
+
+        # Other threads take a socket in self.socket to mean we're connected, so it's
+        # only stored there once it is.
+        sock = None
+        try:
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
+            sock.settimeout(self.sendTimeout)
+            sock.connect(self.address)
+            if self.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        except socket.error:
+            if sock is not None:
+                sock.close()
+            return False
+        self.socket = sock
+        return True
+
+    def _disconnect(self):
+        # Close and forget our socket, if any. close() can itself fail on a dead
+        # connection, but we still need to release the descriptor and reconnect later.
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
         self.socket = None
 
+    def selectable(self):
+        """Return our socket if it should be watched with select(), or None. The OPC
+           server never sends us anything, so the socket only becomes readable when the
+           server hangs up; then call hangup().
+           """
+        return self.socket
+
+    def hangup(self):
+        """Check our socket after select() says it's readable, and disconnect
+           if the server has closed it. The next send will reconnect.
+           """
+
+        try:
+            closed = not self.socket.recv(4096)
+        except socket.error:
+            closed = True
+        if closed:
+            self._disconnect()
 
     def send(self, packet):
         """Send a low-level packet to the OPC server, connecting if necessary
@@ -47,25 +130,61 @@ class FastOPC(object):
            """
 
         if self.socket is None:
-            try:
-                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.socket.connect((self.host, self.port))
-                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
-            except socket.error:
-                self.socket = None
+            self._connect()
 
         if self.socket is not None:        
             try:
                 self.socket.send(packet)
                 return True
             except socket.error:
-                self.socket = None
+                self._disconnect()
 
         # Limit CPU usage when polling for a server
         time.sleep(0.1)
 
         return False
 
+    def sendParts(self, *parts):
+        """Send one message made of several strings or buffers, such as a header and
+           a slice of a larger buffer, without joining them first. Returns True on success.
+           """
+
+        if self.socket is None:
+            self._connect()
+
+        if self.socket is not None:
+            try:
+                for part in parts[:-1]:
+                    self.socket.sendall(part, MSG_MORE)
+                self.socket.sendall(parts[-1])
+                return True
+            except socket.error:
+                self._disconnect()
+
+        # Limit CPU usage when polling for a server
+        time.sleep(0.1)
+
+        return False
+
+    def sendFrame(self, frame):
+        """Send a complete pixel message, such as one from makeFrame(). With a keepalive
+           interval set, a frame identical to the previous one is skipped unless the
+           keepalive interval has passed or we aren't connected. Returns True if the frame
+           was sent or skipped, False if sending failed.
+           """
+
+        if self.keepalive is not None:
+            now = time.time()
+            if (self.socket is not None and now < self._lastFrameTime + self.keepalive
+                    and frame == self._lastFrame):
+                # Byte-for-byte comparison, done with memcmp()
+                self.suppressed += 1
+                return True
+            self._lastFrame[:] = frame
+            self._lastFrameTime = now
+
+        return self.send(frame)
+
     def putPixels(self, channel, *sources):
         """Send a list of 8-bit colors to the indicated channel. (OPC command 0x00).
            This command accepts a list of pixel sources, which are concatenated and sent.
@@ -94,8 +213,320 @@ class FastOPC(object):
         parts.insert(0, struct.pack('>BBH', channel, 0, bytes))
         self.send(''.join(parts))
 
+    def makeFrame(self, channel, length):
+        """Allocate a reusable buffer for a complete 'set pixel colors' message (OPC command 0x00),
+           with room for 'length' bytes of pixel data after the header. Fill in the pixel data
+           in place, for example with cloud.render_into(), and pass the whole buffer to send().
+           """
+
+        frame = bytearray(self.headerBytes + length)
+        struct.pack_into('>BBH', frame, 0, channel, 0, length)
+        return frame
+
     def sysEx(self, systemId, commandId, msg):
         self.send(struct.pack(">BBHHH", 0, 0xFF, len(msg) + 4, systemId, commandId) + msg)
 
     def setGlobalColorCorrection(self, gamma, r, g, b):
         self.sysEx(1, 1, json.dumps({'gamma': gamma, 'whitepoint':[r,g,b]}))
+
+
+class NullOPC(FastOPC):
+    """Open Pixel Control client which sends nothing, for benchmarks and tests.
+       It counts messages and bytes, and keeps a copy of the most recent message.
+       """
+
+    def __init__(self, keepalive=None):
+        FastOPC.__init__(self, 'unix:/dev/null', keepalive)
+        self.messages = 0
+        self.bytes = 0
+        self.lastMessage = bytearray()
+
+    def send(self, packet):
+        self.messages += 1
+        self.bytes += len(packet)
+        self.lastMessage[:] = packet
+        return True
+
+    def sendParts(self, *parts):
+        self.lastMessage[:] = parts[0]
+        for part in parts[1:]:
+            self.lastMessage += part
+        self.messages += 1
+        self.bytes += len(self.lastMessage)
+        return True
+
+    def makeFrame(self, channel, length):
+        # An OPC message holds at most 65535 bytes of pixels, but nothing is sent here,
+        # so allow larger frames for benchmarking oversized layouts.
+        frame = FastOPC.makeFrame(self, channel, min(length, 0xFFFF))
+        frame.extend(bytearray(length - min(length, 0xFFFF)))
+        return frame
+
+
+class ThreadedOPC(FastOPC):
+    """Open Pixel Control client which never blocks the caller.
+
+       send() copies the packet into a one-deep "latest frame" slot and returns right away.
+       A background thread sends whatever is in the slot, so if the server can't keep up,
+       stale frames are dropped instead of queued. While the server is unreachable the
+       thread retries with exponential backoff, dropping frames in the meantime.
+
+       Messages from sysEx() are queued separately and never dropped in favor of a newer frame.
+       """
+
+    minBackoff = 0.1
+    maxBackoff = 2.0
+
+    def __init__(self, server=None, keepalive=None):
+        FastOPC.__init__(self, server, keepalive)
+
+        # Counters, see stats()
+        self.sent = 0
+        self.dropped = 0
+        self.partial = 0
+        self.disconnects = 0
+
+        # The slot holds the latest frame. It's swapped with the buffer being sent,
+        # so frames of a consistent size are copied in place without allocating.
+        self._cond = threading.Condition()
+        self._slot = bytearray()
+        self._slotFull = False
+        self._sending = bytearray()
+        self._control = collections.deque()
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name='opc-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, packet):
+        """Hand a packet to the sender thread. Replaces any frame that hasn't been
+           sent yet. Returns True if we're currently connected.
+           """
+
+        return self.sendParts(packet)
+
+    def sendParts(self, *parts):
+        """Like send(), for a packet made of several strings or buffers.
+           They're copied into the slot one after another.
+           """
+
+        with self._cond:
+            if self._slotFull:
+                self.dropped += 1
+            self._slot[:] = parts[0]
+            for part in parts[1:]:
+                self._slot += part
+            self._slotFull = True
+            self._cond.notify()
+        return self.socket is not None
+
+    def selectable(self):
+        # The sender thread owns the socket, and notices disconnects itself
+        return None
+
+    def sysEx(self, systemId, commandId, msg):
+        with self._cond:
+            self._control.append(struct.pack(">BBHHH", 0, 0xFF, len(msg) + 4, systemId, commandId) + msg)
+            self._cond.notify()
+
+    def stats(self):
+        """Return a dict of counters: frames sent, frames dropped, partial writes, disconnects,
+           and identical frames suppressed by sendFrame().
+           """
+        return {'sent': self.sent, 'dropped': self.dropped, 'partial': self.partial,
+            'disconnects': self.disconnects, 'suppressed': self.suppressed,
+            'connected': self.socket is not None}
+
+    def close(self):
+        """Stop the sender thread and disconnect."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._disconnect()
+
+    def _next(self):
+        # Wait for the next packet to send. Returns (packet, isControl), or None once closed.
+
+        with self._cond:
+            while not (self._slotFull or self._control or self._closed):
+                self._cond.wait()
+            if self._closed:
+                return None
+            if self._control:
+                return self._control.popleft(), True
+            self._slot, self._sending = self._sending, self._slot
+            self._slotFull = False
+            return self._sending, False
+
+    def _run(self):
+        backoff = self.minBackoff
+
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            packet, isControl = item
+
+            if self.socket is None and not self._connect():
+                # Server is down. Keep control messages for later, but the frame is stale by
+                # the time we try again. Sleep without the lock so send() stays non-blocking.
+                with self._cond:
+                    if isControl:
+                        self._control.appendleft(packet)
+                    else:
+                        self.dropped += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.maxBackoff)
+                continue
+            backoff = self.minBackoff
+
+            try:
+                self._sendAll(packet)
+                if not isControl:
+                    self.sent += 1
+            except socket.error:
+                self._disconnect()
+                self.disconnects += 1
+
+    def _sendAll(self, packet):
+        view = memoryview(packet)
+        while view:
+            count = self.socket.send(view)
+            if count < len(view):
+                self.partial += 1
+            view = view[count:]
+
+
+class MultiOPC(object):
+    """Sends each frame as several OPC messages, to one or more servers.
+
+       'outputs' is a list of dicts, or the name of a JSON file holding one, mapping runs
+       of pixels onto OPC channels:
+
+           [{"server": "127.0.0.1:7890", "channel": 1, "first": 0, "count": 512}, ...]
+
+       sends pixels first to first+count-1 as channel 1 on that server. Pixels are numbered
+       across the whole frame, so the DMX data after the LEDs can be mapped like any other
+       pixel. Each server gets its own ThreadedOPC, so servers are sent to in parallel and
+       a slow one holds up no-one. A server's channels go out together, each as a header
+       followed by its slice of the frame. They're copied once, into that server's slot,
+       so the caller can reuse the frame right away.
+
+       Has the same frame interface as FastOPC: makeFrame(), sendFrame() and sendParts().
+       """
+
+    headerBytes = FastOPC.headerBytes
+
+    def __init__(self, outputs, keepalive=None):
+        if isinstance(outputs, basestring):
+            outputs = json.load(open(outputs))
+        self.outputs = outputs
+
+        self.keepalive = keepalive
+        self.suppressed = 0
+        self._lastFrame = bytearray()
+        self._lastFrameTime = 0
+        self._joined = bytearray()
+
+        for output in outputs:
+            if output['count'] * 3 > 0xFFFF:
+                raise ValueError("OPC channel %d on %s has %d pixels, more than one message holds" %
+                    (output['channel'], output['server'], output['count']))
+
+        # One client per server, and a list of (header, offset, length) for each
+        # of its channels, with the offset and length of its pixels in bytes
+        self.clients = collections.OrderedDict()
+        self._channels = {}
+        for output in outputs:
+            server = output['server']
+            length = output['count'] * 3
+            if server not in self.clients:
+                self.clients[server] = ThreadedOPC(server)
+                self._channels[server] = []
+            self._channels[server].append((struct.pack('>BBH', output['channel'], 0, length),
+                self.headerBytes + output['first'] * 3, length))
+
+        # The (client, parts) to send for each server, made for the last frame buffer
+        # we were given. Callers reuse the same buffer, so these rarely change.
+        self._partsFrame = None
+        self._parts = []
+
+    def makeFrame(self, channel, length):
+        """Allocate a reusable buffer for a whole frame, like FastOPC.makeFrame(). Its header
+           is never sent, and the frame may hold more than one OPC message's worth of pixels.
+           """
+
+        for output in self.outputs:
+            if (output['first'] + output['count']) * 3 > length:
+                raise ValueError("OPC channel %d on %s maps pixels past the end of the frame" %
+                    (output['channel'], output['server']))
+        frame = bytearray(self.headerBytes + length)
+        struct.pack_into('>BBH', frame, 0, channel, 0, min(length, 0xFFFF))
+        return frame
+
+    def connected(self):
+        return all(client.socket is not None for client in self.clients.values())
+
+    def sendFrame(self, frame):
+        """Send a frame from makeFrame() to every server. The keepalive setting works
+           as in FastOPC.sendFrame(). Returns True if every server was sent to.
+           """
+
+        if self.keepalive is not None:
+            now = time.time()
+            if (now < self._lastFrameTime + self.keepalive and frame == self._lastFrame
+                    and self.connected()):
+                self.suppressed += 1
+                return True
+            self._lastFrame[:] = frame
+            self._lastFrameTime = now
+
+        return self._sendChannels(frame)
+
+    def sendParts(self, *parts):
+        """Send a frame given as several strings or buffers, header first."""
+        self._joined[:] = parts[0]
+        for part in parts[1:]:
+            self._joined += part
+        return self._sendChannels(self._joined)
+
+    def _sendChannels(self, frame):
+        if frame is not self._partsFrame:
+            self._parts = []
+            for server, channels in self._channels.items():
+                parts = []
+                for header, offset, length in channels:
+                    parts.append(header)
+                    parts.append(buffer(frame, offset, length))
+                self._parts.append((self.clients[server], parts))
+            self._partsFrame = frame
+
+        ok = True
+        for client, parts in self._parts:
+            ok = client.sendParts(*parts) and ok
+        return ok
+
+    def sysEx(self, systemId, commandId, msg):
+        for client in self.clients.values():
+            client.sysEx(systemId, commandId, msg)
+
+    def setGlobalColorCorrection(self, gamma, r, g, b):
+        for client in self.clients.values():
+            client.setGlobalColorCorrection(gamma, r, g, b)
+
+    def selectable(self):
+        # There's no single socket to watch. Each client notices disconnects when it sends.
+        return None
+
+    def hangup(self):
+        pass
+
+    def stats(self):
+        """Return a dict of per-server counters (see ThreadedOPC.stats)."""
+        return dict((server, client.stats()) for server, client in self.clients.items())
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
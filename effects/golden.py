@@ -0,0 +1,95 @@
+"""Golden-frame regression checks for the lighting effects."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import hashlib
+import numpy
+
+import effects
+import fastopc
+import profiler
+
+
+def makeController(layout="layout/amcp-leds.json", seed=1, **kwargs):
+    """A LightController which is fully deterministic: fake clock, seeded
+       lightning, and a null OPC client which keeps the last frame.
+       """
+
+    clock = profiler.FakeClock()
+    controller = effects.LightController(layout, opc=fastopc.NullOPC(), clock=clock,
+        sleep=clock.sleep, seed=seed, **kwargs)
+
+    # Plenty of lightning, so it's covered by the frames we check
+    controller.params.lightning_new = 0.2
+    controller.params.lightning_chain = 0.5
+    return controller
+
+
+def renderFrames(controller, count):
+    """Run 'count' frames, returning a (count, pixelBytes) array of the rendered pixels."""
+
+    opc = controller.opc
+    start = opc.headerBytes
+    frames = numpy.zeros((count, controller._pixelBytes), numpy.uint8)
+    for i in range(count):
+        controller.runFrame()
+        frames[i] = numpy.frombuffer(opc.lastMessage, numpy.uint8, controller._pixelBytes, start)
+    return frames
+
+
+def checksums(frames):
+    """SHA-1 hex digest of each frame."""
+    return [hashlib.sha1(frame.tostring()).hexdigest() for frame in frames]
+
+
+def record(filename, count=300, seed=1, layout="layout/amcp-leds.json"):
+    """Render frames and save them as a golden reference. Returns the frames."""
+
+    frames = renderFrames(makeController(layout, seed), count)
+    numpy.savez_compressed(filename, frames=frames, seed=seed)
+    return frames
+
+
+def compare(filename, tolerance=0, layout="layout/amcp-leds.json"):
+    """Render the same frames as a golden reference file and compare them.
+
+       With a tolerance of zero, frames must be identical, which is checked by checksum.
+       Otherwise each color channel may differ from the reference by up to 'tolerance'.
+       Returns a dict with the number of frames, how many of them differ at all, the
+       largest channel difference, the first frame out of tolerance or None, and 'ok'.
+       """
+
+    golden = numpy.load(filename)
+    expected = golden['frames']
+    actual = renderFrames(makeController(layout, int(golden['seed'])), len(expected))
+
+    differing = sum(a != b for a, b in zip(checksums(actual), checksums(expected)))
+    diff = numpy.abs(actual.astype(int) - expected.astype(int)).max(axis=1)
+    failed = numpy.nonzero(diff > tolerance)[0]
+
+    return {
+        'frames': len(expected),
+        'differing': differing,
+        'max_diff': int(diff.max()),
+        'first_failure': int(failed[0]) if len(failed) else None,
+        'ok': not len(failed),
+    }
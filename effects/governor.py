@@ -0,0 +1,111 @@
+"""Adaptive frame rate governor for the lighting effects."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import logging
+import cloud
+
+logger = logging.getLogger('amcpserver.effects')
+
+
+class FrameGovernor(object):
+    """Trades rendering quality for a stable frame rate.
+
+       The governor keeps a moving average of the work done per frame, and compares it
+       to the frame budget. If the average stays above 'high' (as a fraction of the budget)
+       for 'patience' frames, it steps down one quality level. If it stays below 'low' for
+       'recovery' frames, it steps back up. The gap between 'high' and 'low' and the longer
+       recovery period keep it from flapping between levels.
+
+       Each quality level is a tuple of (octaves, lightning, fps) where octaves is a limit on
+       the number of noise octaves to render, and lightning and fps are fractions of the
+       controller's original maxLightning and targetFPS. Level 0 is full quality.
+       """
+
+    levels = (
+        (cloud.MAX_OCTAVES, 1.0, 1.0),
+        (3, 1.0, 1.0),
+        (3, 0.5, 1.0),
+        (2, 0.5, 1.0),
+        (2, 0.5, 0.8),
+        (1, 0.3, 0.67),
+    )
+
+    def __init__(self, controller, high=0.85, low=0.5, patience=15, recovery=90, smoothing=0.1):
+        self.controller = controller
+        self.high = high
+        self.low = low
+        self.patience = patience
+        self.recovery = recovery
+        self.smoothing = smoothing
+
+        # Full-quality settings, which the levels are relative to
+        self.targetFPS = controller.targetFPS
+        self.maxLightning = controller.maxLightning
+
+        self.level = 0
+        self.average = 0.0
+        self.changes = 0
+        self._over = 0
+        self._under = 0
+        self._apply()
+
+    def update(self, work):
+        """Record the time spent on one frame's work, in seconds, and adjust quality if needed."""
+
+        self.average += (work - self.average) * self.smoothing
+        load = self.average * self.controller.targetFPS
+
+        if load > self.high:
+            self._over += 1
+            self._under = 0
+            if self._over >= self.patience and self.level + 1 < len(self.levels):
+                self._setLevel(self.level + 1, load)
+        elif load < self.low:
+            self._under += 1
+            self._over = 0
+            if self._under >= self.recovery and self.level > 0:
+                self._setLevel(self.level - 1, load)
+        else:
+            self._over = self._under = 0
+
+    def _setLevel(self, level, load):
+        self.level = level
+        self.changes += 1
+        self._over = self._under = 0
+        self._apply()
+
+        c = self.controller
+        logger.info('action="governor", level="%d", load="%.2f", frame_ms="%.2f", '
+            'octaves="%d", max_lightning="%d", target_fps="%.1f"',
+            level, load, self.average * 1000, c.octaves, c.maxLightning, c.targetFPS)
+
+    def _apply(self):
+        octaves, lightning, fps = self.levels[self.level]
+        c = self.controller
+        c.octaves = octaves
+        c.maxLightning = int(round(self.maxLightning * lightning))
+        if self.maxLightning > 0:
+            c.maxLightning = max(1, c.maxLightning)
+        c.targetFPS = self.targetFPS * fps
+        if c.profiler:
+            c.profiler.budget = 1.0 / c.targetFPS
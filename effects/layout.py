@@ -0,0 +1,110 @@
+"""Loading LED layouts, through a compiled binary cache of each JSON layout file."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+import logging
+import numpy
+import os
+import struct
+
+logger = logging.getLogger('amcpserver.effects')
+
+# Cache format: magic, number of points, and the size and modification time of the
+# JSON file it was made from, then the points as little-endian float64 (x, y, z)
+# triples. Doubles rather than floats, so a Model loaded from the cache is identical
+# to one parsed from JSON.
+MAGIC = 'AMCPLAY2'
+HEADER = struct.Struct('<8sIQd')
+
+
+def cacheFilename(filename):
+    return filename + '.cache'
+
+
+def parse(data):
+    """Return the points in a JSON layout, as an (n, 3) float64 array."""
+    return numpy.array([x['point'] for x in json.loads(data)], dtype=numpy.float64)
+
+
+def load(filename):
+    """Return the points in a JSON layout file, as an (n, 3) float64 array.
+
+       Memory-maps the compiled cache if it was made from a JSON file of the same size
+       and modification time, without reading the JSON at all. Otherwise the JSON is
+       parsed, and the cache is rewritten if we can.
+       """
+
+    stat = os.stat(filename)
+    cache = cacheFilename(filename)
+    try:
+        points = readCache(cache, stat)
+        if points is not None:
+            return points
+    except (IOError, OSError, ValueError):
+        pass
+
+    with open(filename, 'rb') as f:
+        points = parse(f.read())
+    try:
+        writeCache(cache, points, stat)
+    except (IOError, OSError), e:
+        logger.debug('action="write_layout_cache", filename="%s", error="%s"', cache, e)
+    return points
+
+
+def readCache(cache, stat):
+    """Return the points from a cache file as a read-only memory map, or None if it
+       wasn't made from a file with the given os.stat() result.
+       """
+    with open(cache, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        return None
+    magic, count, size, mtime = HEADER.unpack(header)
+    if magic != MAGIC or size != stat.st_size or mtime != stat.st_mtime:
+        return None
+    if os.path.getsize(cache) != HEADER.size + count * 3 * 8:
+        return None
+    if not count:
+        return numpy.zeros((0, 3))
+    return numpy.memmap(cache, dtype='<f8', mode='r', offset=HEADER.size, shape=(count, 3))
+
+
+def writeCache(cache, points, stat):
+    """Atomically replace a cache file with the given points, made from a JSON file
+       with the given os.stat() result.
+       """
+    temp = cache + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(points), stat.st_size, stat.st_mtime))
+        f.write(numpy.asarray(points, dtype='<f8').tostring())
+    os.rename(temp, cache)
+
+
+def compile(filename):
+    """Write the cache for a JSON layout file, and return its points."""
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        points = parse(f.read())
+    writeCache(cacheFilename(filename), points, stat)
+    return points
@@ -370,3 +370,105 @@ fbm_noise4(float x, float y, float z, float w, int octaves, float persistence, f
     }
     return total / max;
 }
+
+/*
+ * Batched 4D noise.
+ *
+ * noise4_batch() evaluates noise4() for NOISE_LANES points at once. The
+ * arithmetic uses GCC vector extensions, which compile to NEON on ARM and SSE or AVX
+ * on x86. Permutation and gradient table lookups are still done one lane at a time.
+ *
+ * setup.py chooses the instruction set at build time. With no vector unit (or with
+ * NOISE_SCALAR defined), NOISE_LANES is 1 and no batch functions are defined; callers
+ * should use the scalar versions above.
+ */
+
+#if defined(NOISE_SCALAR)
+#define NOISE_LANES 1
+#elif defined(__AVX__)
+#define NOISE_LANES 8
+#elif defined(__SSE2__) || defined(__ARM_NEON__) || defined(__ARM_NEON)
+#define NOISE_LANES 4
+#else
+#define NOISE_LANES 1
+#endif
+
+#if NOISE_LANES > 1
+
+typedef float vfloat __attribute__((vector_size(NOISE_LANES * sizeof(float))));
+typedef int vint __attribute__((vector_size(NOISE_LANES * sizeof(int))));
+
+static inline vfloat
+vfloorf(vfloat v) {
+    int n;
+    for (n = 0; n < NOISE_LANES; n++)
+        v[n] = floorf(v[n]);
+    return v;
+}
+
+static inline vfloat
+noise4_batch(vfloat x, vfloat y, vfloat z, vfloat w) {
+    vfloat total = {0};
+    vfloat s = (x + y + z + w) * F4;
+    vfloat i = vfloorf(x + s);
+    vfloat j = vfloorf(y + s);
+    vfloat k = vfloorf(z + s);
+    vfloat l = vfloorf(w + s);
+    vfloat t = (i + j + k + l) * G4;
+
+    vfloat x0 = x - (i - t);
+    vfloat y0 = y - (j - t);
+    vfloat z0 = z - (k - t);
+    vfloat w0 = w - (l - t);
+
+    vint c = ((x0 > y0) & 32) | ((x0 > z0) & 16) | ((y0 > z0) & 8) |
+             ((x0 > w0) & 4) | ((y0 > w0) & 2) | ((z0 > w0) & 1);
+
+    // Per-corner simplex offsets and gradients, gathered one lane at a time.
+    // Corner 'v' is offset along each axis whose rank is at least (4 - v).
+    vfloat ox[5], oy[5], oz[5], ow[5];
+    vfloat gx[5], gy[5], gz[5], gw[5];
+    int n, v;
+
+    for (n = 0; n < NOISE_LANES; n++) {
+        const unsigned char *rank = SIMPLEX[c[n]];
+        int I = (int)i[n] & 255;
+        int J = (int)j[n] & 255;
+        int K = (int)k[n] & 255;
+        int L = (int)l[n] & 255;
+
+        for (v = 0; v < 5; v++) {
+            int i1 = rank[0] >= 4 - v;
+            int j1 = rank[1] >= 4 - v;
+            int k1 = rank[2] >= 4 - v;
+            int l1 = rank[3] >= 4 - v;
+            const float *g = GRAD4[PERM[I + i1 + PERM[J + j1 + PERM[K + k1 + PERM[L + l1]]]] & 0x1f];
+
+            ox[v][n] = i1;
+            oy[v][n] = j1;
+            oz[v][n] = k1;
+            ow[v][n] = l1;
+            gx[v][n] = g[0];
+            gy[v][n] = g[1];
+            gz[v][n] = g[2];
+            gw[v][n] = g[3];
+        }
+    }
+
+    for (v = 0; v < 5; v++) {
+        vfloat xv = x0 - ox[v] + v * G4;
+        vfloat yv = y0 - oy[v] + v * G4;
+        vfloat zv = z0 - oz[v] + v * G4;
+        vfloat wv = w0 - ow[v] + v * G4;
+        vfloat tv = 0.6f - xv*xv - yv*yv - zv*zv - wv*wv;
+        vint mask = tv >= 0.0f;
+
+        tv *= tv;
+        tv = tv * tv * (gx[v]*xv + gy[v]*yv + gz[v]*zv + gw[v]*wv);
+        total += (vfloat) ((vint) tv & mask);
+    }
+
+    return total * 27.0f;
+}
+
+#endif  // NOISE_LANES > 1
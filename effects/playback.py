@@ -0,0 +1,217 @@
+"""Precomputed show playback, from memory-mapped frame files."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import mmap
+import numpy
+import os
+import struct
+import zlib
+
+import effects
+import fastopc
+import profiler
+
+# File header: magic, version, flags, bytes per frame, frame count, frames per second,
+# frames per compressed block, and the file offset of the block index. Padded to 64 bytes.
+MAGIC = 'AMCPSHOW'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIIfIQ')
+HEADER_BYTES = 64
+
+# Header flags
+COMPRESSED = 1
+
+# Block index entries for compressed files: file offset and compressed length
+BLOCK = struct.Struct('<QI')
+
+
+class ShowWriter(object):
+    """Writes a show file: a fixed-size record of RGB pixels for each frame.
+
+       Uncompressed, records are stored back to back after the header, so any frame can be
+       read straight out of a memory map. With 'compress', every 'framesPerBlock' frames are
+       compressed together with zlib, and an index of blocks is written at the end.
+       """
+
+    def __init__(self, filename, frameBytes, fps=30, compress=False, framesPerBlock=30):
+        self.file = open(filename, 'wb')
+        self.frameBytes = frameBytes
+        self.fps = fps
+        self.compress = compress
+        self.framesPerBlock = compress and framesPerBlock or 1
+        self.frameCount = 0
+        self._block = []
+        self._index = []
+        self.file.write('\0' * HEADER_BYTES)
+
+    def write(self, pixels):
+        """Append one frame. 'pixels' is a string or buffer of exactly frameBytes bytes."""
+
+        if len(pixels) != self.frameBytes:
+            raise ValueError("Frame is %d bytes, expected %d" % (len(pixels), self.frameBytes))
+        self.frameCount += 1
+        if self.compress:
+            self._block.append(str(pixels))
+            if len(self._block) == self.framesPerBlock:
+                self._flushBlock()
+        else:
+            self.file.write(pixels)
+
+    def close(self):
+        indexOffset = 0
+        if self.compress:
+            if self._block:
+                self._flushBlock()
+            indexOffset = self.file.tell()
+            for entry in self._index:
+                self.file.write(BLOCK.pack(*entry))
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.compress and COMPRESSED or 0,
+            self.frameBytes, self.frameCount, self.fps, self.framesPerBlock, indexOffset))
+        self.file.close()
+
+    def _flushBlock(self):
+        data = zlib.compress(''.join(self._block))
+        self._index.append((self.file.tell(), len(data)))
+        self.file.write(data)
+        self._block = []
+
+
+class ShowFile(object):
+    """A memory-mapped show file, as written by ShowWriter.
+
+       frame(i) returns a read-only buffer of that frame's pixels. For uncompressed files it
+       points straight into the memory map, so nothing is copied until the bytes go out the
+       socket. For compressed files, one decompressed block at a time is kept.
+       """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, flags, self.frameBytes, self.frameCount, self.fps,
+            self.framesPerBlock, indexOffset) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%r is not a show file" % filename)
+
+        self.compressed = bool(flags & COMPRESSED)
+        self.duration = self.frameCount / float(self.fps)
+        self._blockNumber = None
+        self._blockData = None
+
+        if self.compressed:
+            blocks = (self.frameCount + self.framesPerBlock - 1) // self.framesPerBlock
+            self.index = [BLOCK.unpack_from(self.map, indexOffset + i * BLOCK.size)
+                for i in range(blocks)]
+        elif os.fstat(self.file.fileno()).st_size < HEADER_BYTES + self.frameCount * self.frameBytes:
+            raise ValueError("%r is truncated" % filename)
+
+    def frame(self, i):
+        if self.compressed:
+            block, i = divmod(i, self.framesPerBlock)
+            if block != self._blockNumber:
+                offset, length = self.index[block]
+                self._blockData = zlib.decompress(self.map[offset:offset + length])
+                self._blockNumber = block
+            return buffer(self._blockData, i * self.frameBytes, self.frameBytes)
+
+        return buffer(self.map, HEADER_BYTES + i * self.frameBytes, self.frameBytes)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class ShowPlayback(object):
+    """Playback state for one show, started at 'start' on the LightController's clock.
+
+       The show fades in from the live effect over 'fade' seconds, and unless it loops,
+       fades back out over the last 'fade' seconds. mix() gives the show's share of the
+       output at a given time, and frame() the show's pixels.
+       """
+
+    def __init__(self, show, start, fade=1.0, loop=False):
+        self.show = show
+        self.start = start
+        self.fade = fade
+        self.loop = loop
+        self.end = None if loop else start + show.duration
+
+    def stop(self, now, fade=None):
+        """Fade back to the live effect, starting now."""
+        fade = self.fade if fade is None else fade
+        self.end = min(self.end or now + fade, now + fade)
+        self.fade = fade
+
+    def finished(self, now):
+        return self.end is not None and now >= self.end
+
+    def mix(self, now):
+        if not self.fade:
+            return 1.0
+        level = (now - self.start) / self.fade
+        if self.end is not None:
+            level = min(level, (self.end - now) / self.fade)
+        return max(0.0, min(1.0, level))
+
+    def frame(self, now):
+        i = int((now - self.start) * self.show.fps + 0.5)
+        if self.loop:
+            i %= self.show.frameCount
+        return self.show.frame(min(i, self.show.frameCount - 1))
+
+
+def crossfade(live, show, mix):
+    """Blend show pixels into the live pixels, in place. 'live' is a uint8 array,
+       'show' a buffer of the same size, and 'mix' the show's share between 0 and 1.
+       """
+
+    show = numpy.frombuffer(show, numpy.uint8)
+    blended = live * (1.0 - mix)
+    blended += show * mix
+    blended += 0.5
+    live[:] = blended
+
+
+def renderShow(filename, seconds, layout="layout/amcp-leds.json", fps=30, seed=1,
+        script=None, compress=False):
+    """Pre-render a show file from the live effect, faster than real time.
+
+       'script' is called as script(controller, t) before each frame, with t in seconds
+       from the start of the show, and can change controller.params or add lightning.
+       """
+
+    clock = profiler.FakeClock()
+    controller = effects.LightController(layout, targetFPS=fps, opc=fastopc.NullOPC(),
+        clock=clock, sleep=clock.sleep, seed=seed)
+    writer = ShowWriter(filename, controller._pixelBytes, fps, compress)
+    start = controller.opc.headerBytes
+
+    for i in range(int(seconds * fps)):
+        if script:
+            script(controller, i / float(fps))
+        controller.runFrame()
+        writer.write(buffer(controller.opc.lastMessage, start, controller._pixelBytes))
+
+    writer.close()
@@ -0,0 +1,177 @@
+"""Lighting presets: a compact file format and a store which saves in the background."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import cPickle
+import glob
+import logging
+import os
+import Queue
+import re
+import struct
+import threading
+import time
+
+import effects
+
+logger = logging.getLogger('amcpserver.effects')
+
+# File format: a header with magic, version and field count, then one little-endian
+# double per field, in FIELDS order. New parameters must go at the end of FIELDS, so
+# older files still load; anything they're missing keeps its default value.
+MAGIC = 'AMCPPRST'
+VERSION = 1
+HEADER = struct.Struct('<8sHH')
+
+FIELDS = (
+    'brightness', 'color_bottom', 'color_top', 'contrast', 'detail', 'lacunarity',
+    'lightning_chain', 'lightning_new', 'octaves', 'persistence', 'rotation',
+    'turbulence', 'wind_heading', 'wind_speed',
+)
+
+EXTENSION = '.preset'
+
+
+def pack(params):
+    """Return the file contents for a LightParameters object."""
+    return HEADER.pack(MAGIC, VERSION, len(FIELDS)) + struct.pack(
+        '<%dd' % len(FIELDS), *[getattr(params, name) for name in FIELDS])
+
+
+def unpack(data):
+    """Return a new LightParameters object from file contents, or raise ValueError."""
+    if len(data) < HEADER.size:
+        raise ValueError("Preset is truncated")
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version %d preset" % VERSION)
+    if len(data) != HEADER.size + count * 8:
+        raise ValueError("Preset has the wrong length for %d fields" % count)
+
+    params = effects.LightParameters()
+    values = struct.unpack_from('<%dd' % count, data, HEADER.size)
+    for name, value in zip(FIELDS, values):
+        setattr(params, name, value)
+    return params
+
+
+class PresetStore(object):
+    """Numbered preset slots, kept in memory and saved to 'directory' in the background.
+
+       Every preset in the directory is read once, up front, so get() never touches the
+       disk. save() updates memory right away and hands the file to a writer thread,
+       which replaces it atomically: a crash mid-write leaves the old preset intact.
+       Pickled presets from older versions are read too, and rewritten in the new format.
+       """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.presets = {}
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.saved = 0
+        self.errors = 0
+
+        for filename in glob.glob(os.path.join(directory, 'preset*' + EXTENSION)):
+            self._read(filename, unpack)
+        for filename in glob.glob(os.path.join(directory, 'preset*.pickle')):
+            slot = self._slot(filename)
+            if slot is not None and slot not in self.presets:
+                if self._read(filename, cPickle.loads):
+                    self.save(slot, self.presets[slot])
+
+    def filename(self, slot):
+        return os.path.join(self.directory, 'preset%d%s' % (slot, EXTENSION))
+
+    def _slot(self, filename):
+        match = re.match(r'preset(\d+)\.', os.path.basename(filename))
+        return match and int(match.group(1))
+
+    def _read(self, filename, decode):
+        slot = self._slot(filename)
+        if slot is None:
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            params = effects.LightParameters()
+            params.update(decode(data))
+        except Exception, e:
+            logger.error('action="load_preset", filename="%s", error="%s"', filename, e)
+            return False
+        self.presets[slot] = params
+        return True
+
+    def get(self, slot):
+        """Return the LightParameters in 'slot', or None if it's empty. Don't modify them."""
+        return self.presets.get(slot)
+
+    def save(self, slot, params):
+        """Copy 'params' into 'slot'. The file is written later, by a background thread."""
+        copy = effects.LightParameters()
+        copy.update(params)
+        self.presets[slot] = copy
+        self.queue.put((slot, pack(copy)))
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, name='amcp-presets')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def flush(self, timeout=None):
+        """Wait until every saved preset is on disk, or for at most 'timeout' seconds.
+           Returns True if everything was written.
+           """
+        if timeout is None:
+            self.queue.join()
+            return True
+
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _writer(self):
+        while True:
+            slot, data = self.queue.get()
+            try:
+                self._write(self.filename(slot), data)
+                self.saved += 1
+            except (IOError, OSError), e:
+                self.errors += 1
+                logger.error('action="save_preset", slot="%d", error="%s"', slot, e)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, filename, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, filename)
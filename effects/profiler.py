@@ -0,0 +1,159 @@
+"""Frame timing instrumentation for the lighting effects."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import numpy
+import time
+
+# Child of the server's logger, so reports end up in the same key="value" log
+logger = logging.getLogger('amcpserver.effects')
+
+
+class FakeClock(object):
+    """A clock which only moves when told to. Call it for the current time, like
+       time.time(), and pass its sleep() method in place of time.sleep().
+       """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+class RollingHistogram(object):
+    """A fixed-size window of the most recent samples, summarized as percentiles.
+       Adding a sample is just a list store; all the math happens in summary().
+       """
+
+    def __init__(self, size=512):
+        self.size = size
+        self.samples = [0.0] * size
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % self.size] = value
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def summary(self):
+        """Return a dict with p50, p95, p99 and max over the window, plus the total
+           number of samples ever added. Returns None if there are no samples.
+           """
+
+        n = min(self.count, self.size)
+        if not n:
+            return None
+
+        window = numpy.array(self.samples[:n])
+        p50, p95, p99 = numpy.percentile(window, [50, 95, 99])
+        return {'p50': p50, 'p95': p95, 'p99': p99, 'max': window.max(), 'count': self.count}
+
+
+class FrameProfiler(object):
+    """Per-stage timing for LightController frames.
+
+       Each frame is bracketed by begin() and end(), with mark() called at the end
+       of each stage. Times are in seconds. A frame whose work (excluding the idle time
+       spent waiting for its deadline) takes longer than 'budget' counts as a missed deadline.
+
+       Call input() when a control message arrives. The time from the first input since
+       the last frame until the end of the next frame is recorded as 'input' latency.
+       """
+
+    stages = ('idle', 'lightning', 'color', 'render', 'send', 'frame', 'input')
+
+    def __init__(self, budget, window=512, clock=time.time):
+        self.budget = budget
+        self.clock = clock
+        self.histograms = dict((stage, RollingHistogram(window)) for stage in self.stages)
+        self.frames = 0
+        self.missed = 0
+        self._frameStart = self._mark = clock()
+        self._inputTime = None
+
+    def begin(self):
+        """Start a new frame. Time since the end of the last frame counts as 'idle'."""
+        now = self.clock()
+        self.histograms['idle'].add(now - self._mark)
+        self._frameStart = self._mark = now
+
+    def mark(self, stage):
+        """The named stage just finished."""
+        now = self.clock()
+        self.histograms[stage].add(now - self._mark)
+        self._mark = now
+
+    def end(self):
+        now = self.clock()
+        work = now - self._frameStart
+        self.histograms['frame'].add(work)
+        self.frames += 1
+        if work > self.budget:
+            self.missed += 1
+        if self._inputTime is not None:
+            self.histograms['input'].add(now - self._inputTime)
+            self._inputTime = None
+        self._mark = now
+
+    def input(self, timestamp=None):
+        """A control message just arrived (or arrived at 'timestamp'), and will show up
+           in the next frame.
+           """
+        if self._inputTime is None:
+            self._inputTime = self.clock() if timestamp is None else timestamp
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.frames = 0
+        self.missed = 0
+
+    def report(self):
+        """Return a dict of per-stage summaries (see RollingHistogram.summary)
+           along with the total frame and missed-deadline counts.
+           """
+
+        stages = {}
+        for stage in self.stages:
+            summary = self.histograms[stage].summary()
+            if summary:
+                stages[stage] = summary
+        return {'frames': self.frames, 'missed': self.missed, 'budget': self.budget, 'stages': stages}
+
+    def log(self):
+        """Log the current report in key="value" format, one line per stage."""
+
+        report = self.report()
+        logger.info('action="frame_profile", frames="%d", missed="%d", budget_ms="%.2f"',
+            report['frames'], report['missed'], report['budget'] * 1000)
+        for stage in self.stages:
+            s = report['stages'].get(stage)
+            if s:
+                logger.info('action="frame_profile", stage="%s", p50_ms="%.3f", p95_ms="%.3f", '
+                    'p99_ms="%.3f", max_ms="%.3f"', stage,
+                    s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000)
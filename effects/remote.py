@@ -0,0 +1,313 @@
+"""Run the lighting effects in a separate process, controlled through shared memory."""
+#
+# Copyright (c) 2013 Ardent Heavy Industries, LLC.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import logging
+import mmap
+import multiprocessing
+import numpy
+import os
+import time
+
+import cloud
+import effects
+
+logger = logging.getLogger('amcpserver.effects')
+
+
+class ParameterBlock(object):
+    """Shared memory holding LightParameters and a ring of lightning triggers.
+
+       There's exactly one writer, the controlling process, and one reader, the render
+       process. Neither ever waits for the other. Parameters are protected by a sequence
+       lock: the writer makes the sequence number odd, writes, then makes it even again,
+       and the reader retries if the number was odd or changed while it was reading.
+       Lightning triggers go into a ring buffer, and a trigger only counts once the
+       write index moves past it. If the reader falls more than a ring behind, the
+       oldest triggers are lost.
+
+       The two processes may run on different CPUs, so memory barriers keep each side
+       from seeing the other's stores out of order.
+
+       The block must be created before the render process is forked.
+       """
+
+    ringSize = 64
+
+    # Header slots, as 64-bit floats: sequence number, lightning write index, and the
+    # time of the latest control input
+    SEQUENCE, TRIGGERS, INPUT_TIME = range(3)
+    headerSize = 3
+
+    def __init__(self):
+        self.names = effects.LightParameters.names
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        count = self.headerSize + len(self.names) * 2 + self.ringSize * 3
+        self.map = mmap.mmap(-1, count * 8)
+        self.header = numpy.frombuffer(self.map, numpy.float64, self.headerSize)
+
+        # Each parameter's value, and how long its latest change should take
+        offset = self.headerSize * 8
+        self.values = numpy.frombuffer(self.map, numpy.float64, len(self.names), offset)
+        offset += len(self.names) * 8
+        self.durations = numpy.frombuffer(self.map, numpy.float64, len(self.names), offset)
+        offset += len(self.names) * 8
+        self.ring = numpy.frombuffer(self.map, numpy.float64, self.ringSize * 3,
+            offset).reshape((self.ringSize, 3))
+
+        # Reader state
+        self._lastSequence = -1
+        self._lastValues = [None] * len(self.names)
+        self._readIndex = 0
+
+    def write(self, params, duration=0.0, names=None):
+        """Publish every field of 'params'. The reader should take 'duration' seconds
+           to move the listed 'names', or all of them, to their new values. Other fields
+           keep the duration they were last published with, so a fader moved during a
+           timed transition doesn't cut the rest of it short. Writer only.
+           """
+        header = self.header
+        header[self.SEQUENCE] += 1
+        cloud.memory_barrier()
+        self.values[:] = [getattr(params, name) for name in self.names]
+        if names is None:
+            self.durations[:] = duration
+        else:
+            for name in names:
+                self.durations[self.index[name]] = duration
+        cloud.memory_barrier()
+        header[self.SEQUENCE] += 1
+
+    def read(self, params):
+        """Copy the published parameters into 'params', if they changed since the last
+           read. Returns None if they didn't, otherwise a list of (name, duration) for the
+           parameters that changed. Reader only.
+           """
+
+        while True:
+            sequence = self.header[self.SEQUENCE]
+            if sequence == self._lastSequence:
+                return None
+            if sequence % 2:
+                # Mid-write. Let the writer finish, in case it shares our CPU.
+                time.sleep(0)
+                continue
+            cloud.memory_barrier()
+            values = self.values.tolist()
+            durations = self.durations.tolist()
+            cloud.memory_barrier()
+            if self.header[self.SEQUENCE] == sequence:
+                break
+
+        self._lastSequence = sequence
+        changed = []
+        for name, value, last, duration in zip(self.names, values, self._lastValues, durations):
+            if value != last:
+                setattr(params, name, value)
+                changed.append((name, duration))
+        self._lastValues = values
+        if changed:
+            return changed
+
+    def trigger(self, x, y, z):
+        """Queue a manually positioned lightning bolt. Writer only."""
+        index = int(self.header[self.TRIGGERS])
+        self.ring[index % self.ringSize] = (x, y, z)
+        cloud.memory_barrier()
+        self.header[self.TRIGGERS] = index + 1
+
+    def triggers(self):
+        """Return a list of (x, y, z) triggers queued since the last call. Reader only."""
+        end = int(self.header[self.TRIGGERS])
+        cloud.memory_barrier()
+        start = max(self._readIndex, end - self.ringSize)
+        self._readIndex = end
+        return [tuple(self.ring[i % self.ringSize]) for i in range(start, end)]
+
+    def noteInput(self):
+        self.header[self.INPUT_TIME] = time.time()
+
+    def inputTime(self):
+        return self.header[self.INPUT_TIME]
+
+
+class SharedParameters(effects.LightParameters):
+    """LightParameters which publish every change to a ParameterBlock."""
+
+    def __init__(self, block):
+        object.__setattr__(self, '_block', block)
+        block.write(self)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self._block.write(self, names=(name,))
+
+
+def renderMain(block, kwargs, startTime):
+    """Body of the render process: a LightController which takes its parameters
+       and lightning from 'block'. Logs the time from 'startTime' to its first frame.
+       Exits when the parent process does.
+       """
+
+    parent = os.getppid()
+    controller = effects.LightController(**kwargs)
+    inputTime = block.inputTime()
+
+    # Parameters as last published. The controller's own may be part way there.
+    published = effects.LightParameters()
+
+    # If we're a replacement for a render process that died, its lightning is long over
+    block.triggers()
+
+    try:
+        while os.getppid() == parent:
+            changes = block.read(published)
+            if changes:
+                for name, duration in changes:
+                    controller.transitionTo(published, duration, (name,))
+            for x, y, z in block.triggers():
+                controller.makeLightningBolt(x, y, z)
+
+            if block.inputTime() != inputTime:
+                inputTime = block.inputTime()
+                if controller.profiler:
+                    controller.profiler.input(inputTime)
+
+            controller.runFrame()
+            if startTime is not None:
+                logger.info('action="first_frame", process="render", seconds="%.3f"',
+                    time.time() - startTime)
+                startTime = None
+    except KeyboardInterrupt:
+        pass
+
+
+def superviseMain(block, kwargs, exits, checkPeriod, startTime):
+    """Body of the process which starts render processes, and starts a new one when
+       one exits, sending its exit code to 'exits'. This process never has threads of
+       its own, so it can always fork safely; the server may be running several by the
+       time a render process needs replacing. Exits when the parent process does.
+
+       The first render process times its first frame from 'startTime', and any
+       replacements from when they were forked.
+       """
+
+    parent = os.getppid()
+    try:
+        while True:
+            startTime = startTime or time.time()
+            pid = os.fork()
+            if pid == 0:
+                exits.close()
+                status = 1
+                try:
+                    renderMain(block, kwargs, startTime)
+                    status = 0
+                except Exception:
+                    logger.exception('action="render_process", error="exception"')
+                finally:
+                    os._exit(status)
+
+            # The render process exits by itself once we're gone
+            startTime = None
+            done = 0
+            while not done:
+                if os.getppid() != parent:
+                    return
+                time.sleep(checkPeriod)
+                done, status = os.waitpid(pid, os.WNOHANG)
+
+            if os.WIFSIGNALED(status):
+                exits.send(-os.WTERMSIG(status))
+            else:
+                exits.send(os.WEXITSTATUS(status))
+    except KeyboardInterrupt:
+        pass
+
+
+class RemoteLightController(object):
+    """Stands in for a LightController running in a child process, so that sound
+       loading, preset loading and OSC handling in this process can't delay frames.
+
+       Takes the same keyword arguments as LightController. Changes to 'params' and calls
+       to transitionTo() and makeLightningBolt() are passed through shared memory. There are no frames to run
+       here: runFrame() only logs render processes that died and were restarted.
+
+       Create it before starting any threads. Render processes are forked from a
+       supervisor process made here, never from this one. The render process logs its
+       own first frame, timed from 'startTime' or from when it was forked.
+       """
+
+    opc = None
+    clock = time.time
+
+    # How often the server's main loop should call runFrame(), in seconds
+    checkPeriod = 1.0
+
+    def __init__(self, startTime=None, **kwargs):
+        self.kwargs = kwargs
+        self.block = ParameterBlock()
+        self.params = SharedParameters(self.block)
+        self.restarts = 0
+
+        self._exits, exits = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=superviseMain, name='amcp-render',
+            args=(self.block, self.kwargs, exits, self.checkPeriod, startTime))
+        self.process.daemon = True
+        self.process.start()
+        exits.close()
+        self._supervised = True
+
+    def nextFrameTime(self):
+        return self.clock() + self.checkPeriod
+
+    def runFrame(self):
+        if not self._supervised:
+            return
+        try:
+            while self._exits.poll():
+                logger.error('action="render_process", error="exited", exitcode="%s"',
+                    self._exits.recv())
+                self.restarts += 1
+        except EOFError:
+            # The supervisor is gone. Forking another from here isn't safe.
+            self.process.join()
+            logger.error('action="render_supervisor", error="exited", exitcode="%s"',
+                self.process.exitcode)
+            self._supervised = False
+
+    def noteInput(self):
+        self.block.noteInput()
+
+    def transitionTo(self, params, duration, names=None):
+        if names is None:
+            names = effects.LightParameters.names
+        for name in names:
+            object.__setattr__(self.params, name, getattr(params, name))
+        self.block.write(self.params, duration, names)
+
+    def makeLightningBolt(self, x, y, z=0):
+        self.block.trigger(x, y, z)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
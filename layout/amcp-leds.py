@@ -10,6 +10,8 @@
 #
 
 import math
+import os
+import sys
 
 # Spacing between LEDs, in meters
 spacing = 1.0 / 30
@@ -129,3 +131,9 @@ for controller in range(3):
 open('amcp-leds.json', 'w').write(
 	'[\n' + ',\n'.join('\t{"point": [%.4f, %.4f, %.4f]}' % v for v in leds) + '\n]')
 
+# And the compiled copy the server loads at startup. The server makes this
+# itself if it's missing or out of date, as long as it can write here.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from effects import layout
+layout.compile('amcp-leds.json')
+
@@ -11,26 +11,70 @@ Please use logging in key="value" format for statistics and debugging. Ed wants
 to Splunk the cloud.
 
 """
-import cPickle
+import time
+
+# As early as we can, for measuring the time it takes to get our first frame out
+START_TIME = time.time()
+
+import collections
 import glob
+import inspect
 import logging
 import math
+import multiprocessing
 import os
 import platform
+import select
+import signal
 import socket
-import subprocess
 import sys
-import time
 import struct
+import threading
 
-import pygame
+# The LED pipeline comes first. Sound (pygame), GPIO and Zeroconf (avahi, D-Bus)
+# are imported when they're needed, and set up in the background.
 import effects
+import effects.profiler
+from effects import presets
 import liblo
 
+# Imported by init_mixer(), when sound starts up
+pygame = None
+
+def init_mixer():
+    """Import pygame and start its mixer, if that hasn't happened yet. Call this from
+    the main thread: both import modules, and Python 2 holds a global lock for every
+    import, so a background thread doing this while the main thread holds the lock
+    (say, while importing us) waits for it, and deadlocks if the main thread is
+    waiting for that thread."""
+    global pygame
+    if pygame is None:
+        import pygame
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(44100, -16, 2, MIXER_BUFFER)
+        pygame.mixer.set_num_channels(SOUND_CHANNELS)
+        pygame.mixer.set_reserved(RAIN_CHANNEL + 1)
+
+_on_pi = None
+
 def OnPi():
-    uname_m = subprocess.check_output('uname -m', shell=True).strip()
-    # Assume that an ARM processor means we're on the Pi
-    return uname_m == 'armv6l'
+    global _on_pi
+    if _on_pi is None:
+        # Assume that an ARM processor means we're on the Pi
+        _on_pi = platform.machine() == 'armv6l'
+    return _on_pi
+
+def arg_range(func):
+    # The fewest and most positional arguments 'func' takes. The most is None if
+    # there's no limit, and anything we can't inspect takes any number.
+    try:
+        spec = inspect.getargspec(func)
+    except TypeError:
+        return 0, None
+    count = len(spec.args)
+    if inspect.ismethod(func) and func.__self__ is not None:
+        count -= 1
+    return count - len(spec.defaults or ()), None if spec.varargs else count
 
 # XXX: Hardcoding this for now. Using gethostbyname doesn't
 #      necessarily work, since we need to be specific about the
@@ -49,8 +93,90 @@ MIST_PIN = 18 # = GPIO 24
 SPARE_PIN = 22 # = GPIO 25
 PUMP_PIN = 15 # GPIO 22
 
+# Native threads used for rendering the cloud effect. The OSC server keeps running
+# while they work, since the renderer releases the GIL.
+RENDER_THREADS = min(multiprocessing.cpu_count(), 4)
+
+# Send frames to fcserver from a background thread, dropping frames rather
+# than stalling the render loop if fcserver is slow or restarting.
+OPC_THREADED = True
+
+# Frames identical to the last one are only re-sent this often (seconds)
+OPC_KEEPALIVE = 1.0
+
+# Mapping of LEDs to OPC channels and servers, such as 'layout/amcp-outputs.json',
+# so each Fadecandy board (or each Pi running fcserver) gets its own message.
+# fcserver.json must map the same channels. With None, all LEDs go to one server
+# as channel 0.
+OPC_OUTPUTS = None
+
+# Keep per-stage frame timing statistics, and log them this often (seconds)
+PROFILE_FRAMES = True
+PROFILE_LOG_PERIOD = 60
+
+# Run the lighting effects in their own process, so nothing else the server does
+# (loading sounds or presets, handling OSC) can hold up a frame.
+RENDER_PROCESS = False
+
+# Automatically lower rendering quality (noise octaves, lightning, frame rate)
+# when we can't keep up, and restore it when we can.
+ADAPTIVE_QUALITY = True
+
+# Skip lightning calculations for LEDs where a bolt would add less than one
+# 8-bit step to the color.
+LIGHTNING_THRESHOLD = 1 / 255.0
+
+# Lighting presets, and how long recalling one takes to fade in (seconds)
+PRESET_DIRECTORY = '/home/pi/presets'
+PRESET_FADE = 2.0
+
+# How long shutdown waits for presets that are still being saved (seconds)
+PRESET_FLUSH_TIMEOUT = 5.0
+
 # Sound
 RAIN_FILENAME = 'rain.wav'
+THUNDER_FILENAME = 'thunder_hd.wav'
+SONG_FILENAME = 'its_raining_men.wav'
+
+# Mixer buffer, in samples. Sound starts playing up to this long after a trigger,
+# about 23 ms at 44.1 kHz.
+MIXER_BUFFER = 1024
+
+# Decoded sounds are kept in memory. Files up to SOUND_PRELOAD_BYTES are decoded at
+# startup and kept for good; larger ones are decoded on first use, and the least
+# recently used of those are dropped to stay within SOUND_CACHE_BYTES.
+SOUND_PRELOAD_BYTES = 2 * 1024 * 1024
+SOUND_CACHE_BYTES = 64 * 1024 * 1024
+
+# Mixer channels. RAIN_CHANNEL is reserved for the rain loop; the rest are a pool
+# of voices for effects. When they're all busy, a new sound takes over the oldest
+# voice playing something of the same or lower priority, or is dropped.
+SOUND_CHANNELS = 16
+RAIN_CHANNEL = 0
+PRIORITY_EFFECT = 1
+PRIORITY_THUNDER = 2
+PRIORITY_SONG = 3
+
+# TouchOSC multi-button grids, which send /system/action/x/y with the press state.
+# Routes are cached for buttons with coordinates below GRID_MAX, so clients can't
+# grow the route table without limit.
+GRID_SYSTEMS = ('smb', 'light3')
+GRID_MAX = 32
+
+# State sync to TouchOSC. Only values which changed since we last broadcast them go
+# out, in one bundle per system, and at most once every SYNC_INTERVAL seconds so a
+# room full of controllers doesn't saturate the Wi-Fi. A page change also resends
+# everything, in case a controller just joined, but only every SYNC_FULL_INTERVAL.
+SYNC_INTERVAL = 0.05
+SYNC_FULL_INTERVAL = 10.0
+
+# Faders and XY pads, where only the latest value before each frame matters. Messages
+# to these are held and applied just before the next frame. Everything else, like
+# lightning taps and buttons, is applied in order as it arrives. With RENDER_PROCESS
+# there's no frame here to wait for, and the render process only reads the latest
+# values anyway, so nothing is held.
+COALESCED_SYSTEMS = ('light2',)
+COALESCED_PATHS = ('/light/cloud_z', '/sound/volume', '/sound/rain_volume')
 
 # Setup all our logging. Timestamps will be in localtime.
 # TODO(ed): Figure out how to get the timezone offset in the log, or use UTC
@@ -81,13 +207,24 @@ class AMCPServer(liblo.Server):
         self.socket = socket.fromfd(self.fileno(), socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
 
+        # Lights first, so the cloud is lit as soon as possible. Sound starts
+        # up in the background, and the water valves are set up when first used.
+        self.light = Lighting()
+        self.light.controller.runFrame()
+        if RENDER_PROCESS:
+            # The render process logs its own first frame
+            self.first_frame_seconds = None
+        else:
+            self.first_frame_seconds = time.time() - START_TIME
+            logger.info('action="first_frame", seconds="%.3f"', self.first_frame_seconds)
+
         self.sound_effects = SoundEffects()
         self.water = Water()
-        self.light = Lighting()
+        self.sync = SyncEngine(self.client)
 
         self.systems = {
             'sound': {
-                'sync': self.sound_effects.sync,
+                'sync': self.make_sync(self.sound_effects),
                 'volume': self.sound_effects.volume,
                 'thunder': self.sound_effects.thunder,
                 'rain_volume': self.sound_effects.rain_volume,
@@ -96,17 +233,20 @@ class AMCPServer(liblo.Server):
             },
 
             'light': {
-                'sync': self.light.sync,
+                'sync': self.make_sync(self.light),
                 'lightning': self.light.strobe,
                 'cloud_z': self.light.cloud_z,
                 'cloud_xy': self.light.cloud_xy,
             },
 
             'light2': {
-                'sync': self.light.sync,
+                'sync': self.make_sync(self.light),
                 'brightness': self.light.brightness,
                 'contrast': self.light.contrast,
                 'detail': self.light.detail,
+                'octaves': self.light.octaves,
+                'persistence': self.light.persistence,
+                'lacunarity': self.light.lacunarity,
                 'color_top': self.light.color_top,
                 'color_bottom': self.light.color_bottom,
                 'turbulence': self.light.turbulence,
@@ -118,11 +258,11 @@ class AMCPServer(liblo.Server):
                 'loadsave': self.light.loadsave,
             },
             'smb': {
-                'sync': self.sound_effects.sync,
+                'sync': self.make_sync(self.sound_effects),
                 'smb_effects': self.sound_effects.smb_sounds,
             },
             'water': {
-                'sync': self.water.sync,
+                'sync': self.make_sync(self.water),
                 'rain': self.water.rain,
                 'mist': self.water.mist,
                 'spare': self.water.spare,
@@ -131,57 +271,254 @@ class AMCPServer(liblo.Server):
             }
         }
 
-    @liblo.make_method(None, None)
-    def catch_all(self, path, args):
-        p = path.split("/")
-        system = p[1]
-
-        try:
-            action = p[2]
-        except IndexError:  # No action, must be a page change
-            logger.debug('action="active_page", page="%s"' % system)
-
-            # Pages aren't strictly delineated by subsystem, and we don't have much data
-            # to send. Sync everything.
-            return self.sync_systems()
-
-        if system == 'smb' or system == 'light3':
-            x = p[3]
-            y = p[4]
-            self.systems[system][action](x=x, y=y, press=args[0])
-
-        try:
-            self.systems[system][action](*args)
-        except KeyError:
-            logger.error(
-                'action="catch_all", path="%s", error="not found" args="%s", '
-                'system="%s", action=%s'
-                % (path, args, system, action))
-
+        # Precompiled routing table, from full OSC path to (route, least, most): a function
+        # taking the message arguments, and how many it takes. Grid buttons are added the
+        # first time we see them.
+        self.routes = {}
+        self.gridActions = {}
+        self.coalesced = set()
+        for system, actions in self.systems.items():
+            for action, handler in actions.items():
+                path = '/%s/%s' % (system, action)
+                if system in GRID_SYSTEMS and action != 'sync':
+                    self.gridActions[path] = handler
+                else:
+                    self.routes[path] = self.make_route(system, handler)
+                if (not RENDER_PROCESS and action != 'sync' and
+                        (system in COALESCED_SYSTEMS or path in COALESCED_PATHS)):
+                    self.coalesced.add(path)
+
+        # Latest (route, args) for each coalesced path since the last frame
+        self.pending = {}
+
+        # Message counters. Superseded messages were replaced by a newer value before
+        # they were applied.
+        self.received = 0
+        self.applied = 0
+        self.superseded = 0
+        self.stats_time = time.time()
+
+    def make_route(self, system, handler):
         if system == 'water':
             # Be extra vigilant in keeping the water state sync'ed-
             # We should get a positive ACK from the server every time something
             # changes. (Users can see the RX light blink as a confirmation).
-            # This also takes care of the 'all rain off' state.
-            self.systems[system]['sync'](self.client)
+            # This also takes care of the 'all rain off' state. The values are sent
+            # even if they didn't change, so a client that got out of step hears back.
+            def route(*args):
+                handler(*args)
+                self.sync_system(self.water, force=True)
+            return (route,) + arg_range(handler)
+
+        return (handler,) + arg_range(handler)
+
+    def make_sync(self, subsystem):
+        # Handler for a /system/sync message: resend everything for that subsystem
+        def sync(*args):
+            self.sync_system(subsystem, force=True)
+        return sync
+
+    def compile_route(self, path):
+        # Return the route table entry for a path that isn't in the table yet, or None
+        # if it's unknown.
+        # Only grid buttons are added to the table; any other path a client makes up
+        # would stay there forever.
+
+        if path.count('/') == 1:
+            # No action, must be a page change. Page names are up to the client.
+            return self.page_change, 0, None
+
+        # A grid button, like /smb/smb_effects/2/3. Its coordinates are parsed once, here.
+        try:
+            prefix, x, y = path.rsplit('/', 2)
+            handler = self.gridActions[prefix]
+        except (ValueError, KeyError):
+            return None
 
-    def sync_systems(self):
-        for sys in self.systems:
-            try:
-                self.systems[sys]['sync'](self.client)
-            except KeyError:
-                logger.warn('action="sync_systems", system="%s", '
-                            'error="no sync method defined', sys)
+        def route(press, *args):
+            handler(x=x, y=y, press=press)
+
+        entry = (route, 1, None)
+        if x.isdigit() and y.isdigit() and int(x) < GRID_MAX and int(y) < GRID_MAX:
+            self.routes[path] = entry
+        return entry
+
+    def page_change(self, *args):
+        # Pages aren't strictly delineated by subsystem, and we don't have much data
+        # to send. Sync everything that changed, or now and then, everything.
+        logger.debug('action="active_page"')
+        self.sync_systems(force=self.sync.full_sync_due())
+
+    @liblo.make_method(None, None)
+    def catch_all(self, path, args):
+        self.light.controller.noteInput()
+        self.received += 1
+
+        entry = self.routes.get(path) or self.compile_route(path)
+        if entry is None:
+            logger.error('action="catch_all", path="%s", error="not found", args="%s"',
+                         path, args)
+            return
+
+        route, least, most = entry
+        if len(args) < least or (most is not None and len(args) > most):
+            # Like one value sent to an XY pad
+            logger.error('action="catch_all", path="%s", error="wrong number of arguments", '
+                         'args="%s"', path, args)
+            return
+
+        if path in self.coalesced:
+            if path in self.pending:
+                self.superseded += 1
+            self.pending[path] = (route, args)
+            return
+
+        # Anything else happens right away, after the values held so far
+        if self.pending:
+            self.flush_pending()
+        route(*args)
+        self.applied += 1
+
+    def flush_pending(self):
+        """Apply the latest value held for each coalesced path."""
+        pending, self.pending = self.pending, {}
+        for route, args in pending.values():
+            route(*args)
+            self.applied += 1
+
+    def log_stats(self):
+        logger.info('action="osc_stats", received="%d", applied="%d", superseded="%d", '
+                    'sync_bundles="%d", sync_messages="%d"',
+                    self.received, self.applied, self.superseded,
+                    self.sync.bundles, self.sync.messages)
+        if self.sound_effects.so:
+            self.sound_effects.so.log_stats()
+
+    def sync_system(self, subsystem, force=False):
+        self.sync.update(subsystem.system, subsystem.sync_values(), force)
+
+    def sync_systems(self, force=False):
+        for subsystem in (self.sound_effects, self.water, self.light):
+            self.sync_system(subsystem, force)
 
     def mainLoop(self):
-        while True:
+        """Wait for OSC messages, OPC disconnects, the next frame deadline, or a state
+           sync held back by rate limiting, whichever comes first. OSC messages are handled
+           as soon as they arrive, and frames are rendered on time, so the loop only wakes
+           up when there's work to do.
+           """
 
-            # Drain all pending messages without blocking
-            while self.recv(0):
-                pass
+        controller = self.light.controller
+        opc = controller.opc
 
-            # Frame rate limiting and rendering
-            server.light.controller.runFrame()
+        while True:
+            frameTimeout = controller.nextFrameTime() - controller.clock()
+            timeout = frameTimeout
+            if self.sync.pending:
+                timeout = min(timeout, self.sync.next_flush_time() - time.time())
+
+            if timeout > 0:
+                fds = [self.fileno()]
+                opcSocket = opc and opc.selectable()
+                if opcSocket is not None:
+                    fds.append(opcSocket)
+
+                try:
+                    readable = select.select(fds, [], [], timeout)[0]
+                except select.error:
+                    # Interrupted by a signal
+                    continue
+
+                if readable:
+                    if opcSocket in readable:
+                        opc.hangup()
+
+                    # Drain all pending messages without blocking
+                    while self.recv(0):
+                        pass
+                    continue
+
+            # State sync held back by rate limiting
+            self.sync.flush()
+            if frameTimeout > 0:
+                continue
+
+            # Frame rate limiting and rendering, with the latest fader values
+            if self.pending:
+                self.flush_pending()
+            controller.runFrame()
+
+            if time.time() > self.stats_time + PROFILE_LOG_PERIOD:
+                self.stats_time = time.time()
+                self.log_stats()
+
+
+class SyncEngine():
+    """Sends state to TouchOSC clients, skipping values they already have.
+
+       Each subsystem's values are a list of (path, args) pairs. update() compares them to
+       what we last sent and queues the differences. flush() sends what's queued, as one
+       bundle per subsystem, unless we sent something less than 'interval' seconds ago;
+       then it's left for a later flush(), which the server's main loop calls at
+       next_flush_time().
+       """
+
+    def __init__(self, client, interval=SYNC_INTERVAL, full_interval=SYNC_FULL_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.full_interval = full_interval
+        self.sent = {}
+        self.pending = {}
+        self.last_send = 0
+        self.last_full = 0
+
+        # Counters
+        self.bundles = 0
+        self.messages = 0
+
+    def update(self, system, values, force=False):
+        """Queue the values for 'system' that changed since we last sent them, or all
+           of them if 'force' is set, and flush if the rate limit allows.
+           """
+
+        pending = self.pending.setdefault(system, {})
+        for path, args in values:
+            if force or self.sent.get(path) != args:
+                pending[path] = args
+            else:
+                pending.pop(path, None)
+        if not pending:
+            del self.pending[system]
+        self.flush()
+
+    def next_flush_time(self):
+        return self.last_send + self.interval
+
+    def flush(self):
+        if not self.pending:
+            return
+        now = time.time()
+        if now < self.next_flush_time():
+            return
+        self.last_send = now
+
+        for system, values in self.pending.items():
+            logger.debug('system="%s", action="sync", client="%r", values="%d"',
+                         system, self.client, len(values))
+            liblo.send(self.client, liblo.Bundle(
+                *[liblo.Message(path, *args) for path, args in values.items()]))
+            self.sent.update(values)
+            self.bundles += 1
+            self.messages += len(values)
+        self.pending.clear()
+
+    def full_sync_due(self):
+        """True if it's been full_interval seconds since this last returned True."""
+        now = time.time()
+        if now < self.last_full + self.full_interval:
+            return False
+        self.last_full = now
+        return True
 
 
 class Water():
@@ -196,12 +533,8 @@ class Water():
             'pump': 0.0,
         }
 
-    def sync(self, client):
-        logger.debug(
-            'system="%s", action="sync", client=%r, toggles=%s',
-            self.system, client, self.toggles)
-        for t in self.toggles:
-            liblo.send(client, ("/%s/%s" % (self.system, t)), self.toggles[t])
+    def sync_values(self):
+        return [("/%s/%s" % (self.system, t), (self.toggles[t],)) for t in self.toggles]
 
     def toggle_state(self, action, pin, toggle):
         self.pi.send(pin, toggle and 1 or 0)
@@ -241,40 +574,52 @@ class Lighting():
     detailScale = 3.0
     turbulenceScale = 0.4
     windSpeedScale = 0.8
+    lacunarityScale = 4.0
 
     def __init__(self):
         self.system = 'light'
-        self.controller = effects.LightController()
+        if RENDER_PROCESS:
+            from effects import remote
+            controllerClass = remote.RemoteLightController
+            options = {'startTime': START_TIME}
+        else:
+            controllerClass = effects.LightController
+            options = {}
+
+        self.controller = controllerClass(renderThreads=RENDER_THREADS,
+                                          lightningThreshold=LIGHTNING_THRESHOLD,
+                                          profile=PROFILE_FRAMES,
+                                          profileLogPeriod=PROFILE_LOG_PERIOD,
+                                          threadedOPC=OPC_THREADED,
+                                          keepalive=OPC_KEEPALIVE,
+                                          outputs=OPC_OUTPUTS,
+                                          adaptive=ADAPTIVE_QUALITY,
+                                          **options)
         self.lightningProbability = 0
-
-    def sync(self, client):
-        logger.debug('system="%s", action="sync", client="%r"',
-                     self.system, client)
-
-        liblo.send(client, liblo.Bundle(
-
-            # Gross, this needs refactoring...
-            liblo.Message("/light/cloud_z", self.controller.params.lightning_new / self.lightningProbabilityScale),
-            liblo.Message("/light2/brightness", self.controller.params.brightness / self.brightnessScale),
-            liblo.Message("/light2/contrast", self.controller.params.contrast / self.contrastScale),
-            liblo.Message("/light2/detail", self.controller.params.detail / self.detailScale),
-            liblo.Message("/light2/color_top", self.controller.params.color_top),
-            liblo.Message("/light2/color_bottom", self.controller.params.color_bottom),
-            liblo.Message("/light2/turbulence", self.controller.params.turbulence / self.turbulenceScale),
-            liblo.Message("/light2/speed", self.controller.params.wind_speed / self.windSpeedScale),
+        self.presets = presets.PresetStore(PRESET_DIRECTORY)
+
+    def sync_values(self):
+        params = self.controller.params
+        return [
+            ("/light/cloud_z", (params.lightning_new / self.lightningProbabilityScale,)),
+            ("/light2/brightness", (params.brightness / self.brightnessScale,)),
+            ("/light2/contrast", (params.contrast / self.contrastScale,)),
+            ("/light2/detail", (params.detail / self.detailScale,)),
+            ("/light2/octaves", ((params.octaves - 1) / float(effects.cloud.MAX_OCTAVES - 1),)),
+            ("/light2/persistence", (params.persistence,)),
+            ("/light2/lacunarity", (params.lacunarity / self.lacunarityScale,)),
+            ("/light2/color_top", (params.color_top,)),
+            ("/light2/color_bottom", (params.color_bottom,)),
+            ("/light2/turbulence", (params.turbulence / self.turbulenceScale,)),
+            ("/light2/speed", (params.wind_speed / self.windSpeedScale,)),
 
             # XXX: This doesn't work- TouchOSC seems to spam these events
             #      at both XY pads for some reason. Bug in TouchOSC? Using
             #      liblo incorrectly?
             #
-            # liblo.Message("/light2/heading",
-            #     -math.cos(self.controller.params.wind_heading),
-            #     math.sin(self.controller.params.wind_heading)),
-            #
-            # liblo.Message("/light2/rotation",
-            #     math.sin(-self.controller.params.rotation),
-            #     -math.cos(-self.controller.params.rotation))
-            ))
+            # ("/light2/heading", (-math.cos(params.wind_heading), math.sin(params.wind_heading))),
+            # ("/light2/rotation", (math.sin(-params.rotation), -math.cos(-params.rotation))),
+            ]
 
     def strobe(self, press):
         """ Light up cloud for as long as button is held. """
@@ -303,6 +648,16 @@ class Lighting():
     def detail(self, detail):
         self.controller.params.detail = detail * self.detailScale
 
+    def octaves(self, octaves):
+        """ Fader from 1 octave up to MAX_OCTAVES. """
+        self.controller.params.octaves = 1 + int(round(octaves * (effects.cloud.MAX_OCTAVES - 1)))
+
+    def persistence(self, persistence):
+        self.controller.params.persistence = persistence
+
+    def lacunarity(self, lacunarity):
+        self.controller.params.lacunarity = lacunarity * self.lacunarityScale
+
     def color_top(self, color_top):
         self.controller.params.color_top = color_top
 
@@ -330,13 +685,15 @@ class Lighting():
 
     def save(self, slot):
         logger.info('Saving to slot %d', slot)
-        cPickle.dump(self.controller.params,
-                open('/home/pi/presets/preset%d.pickle' % (slot,), 'w'))
+        self.presets.save(slot, self.controller.params)
 
     def load(self, slot):
         logger.info('Loading from slot %d', slot)
-        self.controller.params = cPickle.load(
-                open('/home/pi/presets/preset%d.pickle' % (slot,), 'r'))
+        params = self.presets.get(slot)
+        if params is None:
+            logger.warning('action="load_preset", slot="%d", error="empty"', slot)
+            return
+        self.controller.transitionTo(params, PRESET_FADE)
 
 class SoundEffects():
     """Play different sound effects.
@@ -345,45 +702,71 @@ class SoundEffects():
     def __init__(self):
         self.system = 'sound'
         #self.smb_sound_list = os.listdir(os.path.join(MEDIA_DIRECTORY, 'smb'))
-        self.smb_sound_list = glob.glob(
-            os.path.join(MEDIA_DIRECTORY, 'smb', 'smb*'))
-        self.so = SoundOut()
-        self.so.initRain(os.path.join(MEDIA_DIRECTORY, RAIN_FILENAME))
-
-        self.values = {}
-        self.volume(0.3)
-        self.rain_volume(0)
-
-    def sync(self, client):
-        logger.debug('system="%s", action="sync", client="%r"',
-                     self.system, client)
-        for t in self.values:
-            liblo.send(client, ("/%s/%s" % (self.system, t)), self.values[t])
+        # Sorted, so each grid position always plays the same sound
+        self.smb_sound_list = sorted(glob.glob(
+            os.path.join(MEDIA_DIRECTORY, 'smb', 'smb*')))
+        self.thunder_file = os.path.join(MEDIA_DIRECTORY, THUNDER_FILENAME)
+        self.song_file = os.path.join(MEDIA_DIRECTORY, SONG_FILENAME)
+        self.values = {'volume': 0.3, 'rain_volume': 0}
+
+        # Starting the mixer and decoding sounds takes a while, so it happens in the
+        # background. Until it's done, self.so is None and sounds don't play, but
+        # volume changes are kept for when it's ready.
+        self.so = None
+        init_mixer()
+        self.init_thread = threading.Thread(target=self.init_sound, name='amcp-sound')
+        self.init_thread.daemon = True
+        self.init_thread.start()
+
+    def init_sound(self):
+        start = time.time()
+        try:
+            so = SoundOut(self.values['volume'])
+            so.initRain(os.path.join(MEDIA_DIRECTORY, RAIN_FILENAME))
+            so.setRainVolume(self.values['rain_volume'])
+            so.bank.preload(self.smb_sound_list + [self.thunder_file, self.song_file])
+        except Exception, err:
+            # Nobody's waiting on this thread, so say why sound is off
+            logger.exception('action="sound_init_failed", error="%s"', err)
+            return
+
+        # Catch up on anything that changed while we were busy
+        self.so = so
+        so.setVolume(self.values['volume'])
+        so.setRainVolume(self.values['rain_volume'])
+        logger.info('action="sound_ready", seconds="%.2f", since_start="%.2f"',
+                    time.time() - start, time.time() - START_TIME)
+
+    def sync_values(self):
+        return [("/%s/%s" % (self.system, t), (self.values[t],)) for t in self.values]
 
     def rain_volume(self, volume):
         self.values['rain_volume'] = volume
-        self.so.setRainVolume(volume)
+        if self.so:
+            self.so.setRainVolume(volume)
 
     def volume(self, volume):
         self.values['volume'] = volume
-        self.so.setVolume(volume)
+        if self.so:
+            self.so.setVolume(volume)
 
-    def press_play(self, sound_file):
-        self.so.play(sound_file)
+    def press_play(self, sound_file, priority=PRIORITY_EFFECT):
+        if self.so is None:
+            logger.info('action="play", soundfile="%s", error="sound not ready"', sound_file)
+            return
+        self.so.play(sound_file, priority)
 
     def silence(self, press):
-        if press:
+        if press and self.so:
             self.so.stop()
 
     def thunder(self, press):
-        sound_file = os.path.join(MEDIA_DIRECTORY, 'thunder_hd.wav')
         if press:
-            self.press_play(sound_file)
+            self.press_play(self.thunder_file, PRIORITY_THUNDER)
 
     def its_raining_men(self, press):
-        sound_file = os.path.join(MEDIA_DIRECTORY, 'its_raining_men.wav')
         if press:
-            self.press_play(sound_file)
+            self.press_play(self.song_file, PRIORITY_SONG)
 
     def smb_sounds(self, x=None, y=None, press=None):
         if press:
@@ -392,6 +775,71 @@ class SoundEffects():
             self.press_play(sound_file)
 
 
+class SoundBank():
+    """Decoded sounds, ready to play, by filename.
+
+    preload() decodes small files right away and keeps them. Anything else is
+    decoded by get() the first time it's needed, and kept until it's the least
+    recently used and we're over our byte budget."""
+    def __init__(self, budget=SOUND_CACHE_BYTES, preload_limit=SOUND_PRELOAD_BYTES):
+        init_mixer()
+        self.budget = budget
+        self.preload_limit = preload_limit
+        self.sounds = collections.OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def preload(self, filenames):
+        start = time.time()
+        for filename in filenames:
+            if os.path.exists(filename) and os.path.getsize(filename) <= self.preload_limit:
+                self.load(filename, pinned=True)
+        logger.info('action="preload_sounds", sounds="%d", seconds="%.2f"',
+                    len(self.pinned), time.time() - start)
+
+    def load(self, filename, pinned=False):
+        # Pinned sounds are kept for good, and don't count against the budget
+        try:
+            sound = pygame.mixer.Sound(filename)
+        except pygame.error, err:
+            logger.error('action="load_sound", soundfile="%s", error="%s"', filename, err)
+            return None
+
+        # Decoded size, from the sound's length and the mixer's format
+        frequency, format, channels = pygame.mixer.get_init()
+        size = int(sound.get_length() * frequency * channels * abs(format) // 8)
+
+        self.sounds[filename] = sound
+        self.sizes[filename] = size
+        if pinned:
+            self.pinned.add(filename)
+        else:
+            self.cached_bytes += size
+            self.evict()
+        return sound
+
+    def evict(self):
+        for filename in list(self.sounds):
+            if self.cached_bytes <= self.budget:
+                return
+            if filename not in self.pinned:
+                del self.sounds[filename]
+                self.cached_bytes -= self.sizes.pop(filename)
+
+    def get(self, filename):
+        """Return the decoded sound, or None if it can't be loaded."""
+        sound = self.sounds.pop(filename, None)
+        if sound is None:
+            self.misses += 1
+            return self.load(filename)
+        self.hits += 1
+        self.sounds[filename] = sound    # Now the most recently used
+        return sound
+
+
 class SoundOut():
     """mplayer to RPi audio out"""
     def __init__(self, defaultVolume=20):
@@ -400,13 +848,27 @@ class SoundOut():
         if OnPi():
             print "Init mixer"
             os.system("amixer sset PCM 0")
-        self.sounds = []
-        pygame.mixer.init(44100)
+        init_mixer()
+        self.bank = SoundBank()
+
+        # Voices in use, as {channel number: (sound, channel, priority, start time)},
+        # and the channel numbers known to be free.
+        self.voices = {}
+        self.free = [i for i in range(SOUND_CHANNELS) if i != RAIN_CHANNEL]
+        self.stolen = 0
+        self.dropped = 0
         self.setVolume(defaultVolume)
+
+        # Time from a trigger until the sound is handed to the mixer. After that
+        # it starts within one mixer buffer.
+        self.trigger_latency = effects.profiler.RollingHistogram()
+        frequency = pygame.mixer.get_init()[0]
+        self.buffer_latency = MIXER_BUFFER / float(frequency)
     
     def initRain(self, rain_filename):
         self.rain = pygame.mixer.Sound(rain_filename)
-        self.rain_channel = self.rain.play(loops=-1, fade_ms=2000)
+        self.rain_channel = pygame.mixer.Channel(RAIN_CHANNEL)
+        self.rain_channel.play(self.rain, loops=-1, fade_ms=2000)
    
     def setRainVolume(self, volume):
         self.rain.set_volume(volume)
@@ -414,30 +876,73 @@ class SoundOut():
     def setVolume(self, volume):
         self.volume = volume
         self.prune_sounds()
-        for (s, ch) in self.sounds:
+        for (s, ch, priority, started) in self.voices.values():
             s.set_volume(volume)
 
-    def play(self, soundfile):
+    def play(self, soundfile, priority=PRIORITY_EFFECT):
+        start = time.time()
         logger.debug('action="play", soundfile="%s"' % soundfile)
-        s = pygame.mixer.Sound(soundfile)
-        ch = s.play()
+        s = self.bank.get(soundfile)
+        if s is None:
+            return None
+        index = self.take_voice(priority)
+        if index is None:
+            self.dropped += 1
+            logger.debug('action="drop_sound", soundfile="%s"', soundfile)
+            return None
+        ch = pygame.mixer.Channel(index)
         s.set_volume(self.volume)
-        self.sounds.append((s, ch))
+        ch.play(s)
+        self.trigger_latency.add(time.time() - start)
+        self.voices[index] = (s, ch, priority, start)
         return (s, ch)
 
+    def take_voice(self, priority):
+        """Return a free channel number, stealing one if need be, or None."""
+        if not self.free:
+            self.prune_sounds()
+        if self.free:
+            return self.free.pop()
+
+        # Oldest of the lowest priority voices, if it doesn't outrank us
+        index, (s, ch, victim, started) = min(self.voices.items(),
+                                              key=lambda (i, v): (v[2], v[3]))
+        if victim > priority:
+            return None
+        ch.stop()
+        del self.voices[index]
+        self.stolen += 1
+        return index
+
+    def log_stats(self):
+        latency = self.trigger_latency.summary()
+        if latency:
+            logger.info('action="sound_stats", trigger_p50_ms="%.2f", trigger_max_ms="%.2f", '
+                        'buffer_ms="%.1f", cache_hits="%d", cache_misses="%d", cached_bytes="%d", '
+                        'voices="%d", stolen="%d", dropped="%d"',
+                        latency['p50'] * 1000, latency['max'] * 1000, self.buffer_latency * 1000,
+                        self.bank.hits, self.bank.misses, self.bank.cached_bytes,
+                        len(self.voices), self.stolen, self.dropped)
+
     def stop(self):
         self.prune_sounds()
-        for (s, ch) in self.sounds:
-            s.fadeout(2000)
+        for (s, ch, priority, started) in self.voices.values():
+            ch.fadeout(2000)
 
     def prune_sounds(self):
-        for idx, (s, ch) in enumerate(self.sounds[:]):
+        """Free the voices whose sounds have finished. There are never more than
+        SOUND_CHANNELS of them to check."""
+        for index, (s, ch, priority, started) in self.voices.items():
             if not ch.get_busy():
-                self.sounds.remove((s,ch))
+                del self.voices[index]
+                self.free.append(index)
 
 class PiGPIO():
-    """Controls water (pumps and valves)"""
+    """Controls water (pumps and valves). The GPIO pins are set up on first use."""
     def __init__(self):
+        self.output = None
+
+    def setup(self):
         if OnPi():
             import RPi.GPIO as GPIO
             GPIO.setmode(GPIO.BOARD)
@@ -455,9 +960,22 @@ class PiGPIO():
         """Send value (1/0) to pin_num"""
         logger.debug('action="send_rpi_gpio", pin_number="%i", value="%i"'
                      % (pin_num, value))
+        if self.output is None:
+            self.setup()
         self.output(pin_num, value)
 
 
+def announce(services):
+    """Avahi announce so it's findable on the controller by name. Loading avahi
+    and talking to D-Bus is slow, so this runs in its own thread."""
+    from avahi_announce import ZeroconfService
+    service = ZeroconfService(
+        name="AMCP TouchOSC Server", port=8000, stype="_osc._udp")
+    service.publish()
+    services.append(service)
+    logger.info('action="zeroconf_published", since_start="%.2f"', time.time() - START_TIME)
+
+
 if __name__ == "__main__":
 
     try:
@@ -466,33 +984,29 @@ if __name__ == "__main__":
         print str(err)
         sys.exit()
 
-    if platform.system() == "Darwin":
-        service = None
-    else:
-        # Avahi announce so it's findable on the controller by name
-        from avahi_announce import ZeroconfService
-        service = ZeroconfService(
-            name="AMCP TouchOSC Server", port=8000, stype="_osc._udp")
-        service.publish()
+    services = []
+    if platform.system() != "Darwin":
+        zeroconf = threading.Thread(target=announce, args=(services,), name='amcp-zeroconf')
+        zeroconf.daemon = True
+        zeroconf.start()
 
     # Main thread runs both our LED effects and our OSC server,
-    # draining all queued OSC events between frames. Runs until killed.
+    # handling OSC events as they arrive between frames. Runs until killed.
+    # Being stopped by the init script shuts down the same way as Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     try:
         server.mainLoop()
     except KeyboardInterrupt:
-        # Cleanup
-        if service:
-            service.unpublish()
-        if OnPi():
-            import RPi.GPIO as GPIO
-            GPIO.cleanup()
+        pass
 
     finally:
         logger.info('action="server_shutdown"')
 
-        # Cleanup
-        if service:
+        # Cleanup. Presets saved just now may still be on their way to disk.
+        if not server.light.presets.flush(PRESET_FLUSH_TIMEOUT):
+            logger.error('action="save_preset", error="unsaved at shutdown"')
+        for service in services:
             service.unpublish()
         if OnPi():
             import RPi.GPIO as GPIO
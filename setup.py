@@ -1,15 +1,42 @@
 #!/usr/bin/env python
 
+import os
+import platform
 from distutils.core import setup, Extension
 
+# Instruction set for the batched noise kernel in effects/noise.h. Guessed from
+# the build machine, or set AMCP_SIMD to one of 'scalar', 'sse', 'avx', 'neon'.
+# The original Raspberry Pi (armv6l) has no NEON unit, so it gets the scalar code.
+def simd_flags():
+	machine = platform.machine()
+	simd = os.getenv('AMCP_SIMD')
+	if not simd:
+		if machine in ('x86_64', 'AMD64', 'i686', 'i386'):
+			simd = 'sse'
+		elif machine.startswith('armv7') or machine == 'aarch64':
+			simd = 'neon'
+		else:
+			simd = 'scalar'
+
+	if simd == 'neon' and machine == 'aarch64':
+		# NEON is always present on 64-bit ARM
+		return []
+	return {
+		'scalar': ['-DNOISE_SCALAR'],
+		'sse': ['-msse2'],
+		'avx': ['-mavx'],
+		'neon': ['-mfpu=neon'],
+	}[simd]
+
 setup(
     packages=['effects'],
     py_modules=[
     	'server',
     ],
 	ext_modules=[
-		Extension('effects.cloud', ['effects/cloud.c'], 
-			extra_compile_args=['-Os', '-funroll-loops', '-ffast-math'],
+		Extension('effects.cloud', ['effects/cloud.c'],
+			extra_compile_args=['-Os', '-funroll-loops', '-ffast-math', '-pthread'] + simd_flags(),
+			extra_link_args=['-pthread'],
 		),
 	],
 )
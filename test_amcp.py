@@ -6,7 +6,15 @@ import unittest
 
 import server
 
-amcp = server.AMCPServer(8000)
+amcp = None
+
+
+def setUpModule():
+    # Built here rather than at import, so its background threads never run
+    # while the import lock is held
+    global amcp
+    amcp = server.AMCPServer(8000, client_ip='127.0.0.1', client_port=9000)
+    amcp.sound_effects.init_thread.join()
 
 
 class MockProcess():
@@ -27,6 +35,139 @@ class TestAMCP(unittest.TestCase):
             for action in amcp.systems[system]:
                 amcp.catch_all('/%s/%s' % (system, action), [1.0])
 
+    def test_faders_coalesce(self):
+        amcp.flush_pending()
+        applied = amcp.applied
+        for value in (0.1, 0.2, 0.3):
+            amcp.catch_all('/light2/detail', [value])
+        amcp.flush_pending()
+        self.assertEqual(amcp.applied, applied + 1)
+        self.assertAlmostEqual(amcp.light.controller.params.detail, 0.3 * amcp.light.detailScale)
+
+        # Buttons apply right away, after any held values
+        amcp.catch_all('/light2/detail', [0.5])
+        amcp.catch_all('/light/lightning', [1.0])
+        self.assertEqual(amcp.pending, {})
+        self.assertAlmostEqual(amcp.light.controller.params.detail, 0.5 * amcp.light.detailScale)
+
+    @mock.patch('pygame.mixer.Sound')
+    def test_sound_bank_caches(self, mock_sound):
+        mock_sound.return_value.get_length.return_value = 1.0
+        bank = server.SoundBank(budget=2 * 44100 * 4)
+        for filename in ('a.wav', 'b.wav', 'a.wav', 'c.wav', 'b.wav'):
+            bank.get(filename)
+
+        # b was dropped to make room for c, so it's decoded again
+        self.assertEqual(mock_sound.call_count, 4)
+        self.assertEqual((bank.hits, bank.misses), (1, 4))
+        self.assertEqual(list(bank.sounds), ['c.wav', 'b.wav'])
+
+    @mock.patch('os.path.getsize', return_value=1000)
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('pygame.mixer.Sound')
+    def test_preloaded_sounds_outside_budget(self, mock_sound, mock_exists, mock_getsize):
+        mock_sound.return_value.get_length.return_value = 1.0
+        bank = server.SoundBank(budget=2 * 44100 * 4)
+        bank.preload(['p1.wav', 'p2.wav', 'p3.wav'])
+        self.assertEqual(bank.cached_bytes, 0)
+
+        # More preloaded than the budget, but a lazily loaded sound still stays
+        bank.get('a.wav')
+        bank.get('a.wav')
+        self.assertEqual(mock_sound.call_count, 4)
+        self.assertEqual((bank.hits, bank.misses), (1, 1))
+        self.assertEqual(bank.cached_bytes, 44100 * 4)
+
+    @mock.patch('pygame.mixer.Channel')
+    def test_voice_stealing(self, mock_channel):
+        so = server.SoundOut()
+        so.bank.get = mock.Mock()
+        mock_channel.return_value.get_busy.return_value = True
+        for i in range(server.SOUND_CHANNELS - 1):
+            so.play('thunder.wav', server.PRIORITY_THUNDER)
+
+        # Full of higher priority sounds, so an effect is dropped
+        self.assertEqual(so.play('smb.wav', server.PRIORITY_EFFECT), None)
+        self.assertEqual((so.stolen, so.dropped), (0, 1))
+
+        # The same priority takes over the oldest voice
+        so.play('thunder.wav', server.PRIORITY_THUNDER)
+        self.assertEqual((so.stolen, so.dropped), (1, 1))
+        self.assertEqual(len(so.voices), server.SOUND_CHANNELS - 1)
+        self.assertNotIn(server.RAIN_CHANNEL, so.voices)
+
+        # Finished voices are reused
+        mock_channel.return_value.get_busy.return_value = False
+        so.play('smb.wav')
+        self.assertEqual(len(so.voices), 1)
+        self.assertEqual(so.stolen, 1)
+
+    @mock.patch('liblo.send')
+    def test_sync_sends_changes(self, mock_send):
+        sync = server.SyncEngine('client', interval=0)
+        values = [('/water/rain', (0.0,)), ('/water/mist', (1.0,))]
+        sync.update('water', values)
+        sync.update('water', values)
+        self.assertEqual(mock_send.call_count, 1)
+
+        sync.update('water', [('/water/rain', (1.0,)), ('/water/mist', (1.0,))])
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual((sync.bundles, sync.messages), (2, 3))
+
+        # Rate limited: held until the interval has passed
+        sync.interval = 60
+        sync.update('water', values)
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(sync.pending, {'water': {'/water/rain': (0.0,)}})
+
+    @mock.patch('liblo.send')
+    def test_water_always_acknowledged(self, mock_send):
+        interval, amcp.sync.interval = amcp.sync.interval, 0
+        try:
+            amcp.flush_pending()
+            amcp.sync.flush()
+            mock_send.reset_mock()
+            amcp.catch_all('/water/rain', [1.0])
+            amcp.catch_all('/water/rain', [1.0])
+        finally:
+            amcp.sync.interval = interval
+        self.assertEqual(mock_send.call_count, 2)
+
+    def test_grid_buttons_dispatch_once(self):
+        handler = mock.Mock()
+        amcp.gridActions['/light3/loadsave'] = handler
+        amcp.routes.pop('/light3/loadsave/3/4', None)
+        amcp.catch_all('/light3/loadsave/3/4', [1.0])
+        amcp.catch_all('/light3/loadsave/3/4', [0.0])
+        self.assertEqual(handler.call_args_list, [
+            mock.call(x='3', y='4', press=1.0),
+            mock.call(x='3', y='4', press=0.0)])
+
+    def test_wrong_argument_count(self):
+        amcp.flush_pending()
+        applied = amcp.applied
+        amcp.catch_all('/light/cloud_xy', [1.0])
+        amcp.catch_all('/light/lightning', [1.0, 2.0])
+        amcp.flush_pending()
+        self.assertEqual(amcp.applied, applied)
+
+        # Errors from inside a handler aren't mistaken for a bad message
+        handler = mock.Mock(side_effect=TypeError)
+        amcp.routes['/test/broken'] = (handler, 1, 1)
+        try:
+            self.assertRaises(TypeError, amcp.catch_all, '/test/broken', [1.0])
+        finally:
+            del amcp.routes['/test/broken']
+
+    @mock.patch.object(server.AMCPServer, 'sync_systems')
+    def test_made_up_paths_not_cached(self, mock_sync):
+        routes = len(amcp.routes)
+        for i in range(100):
+            amcp.catch_all('/page%d' % i, [])
+            amcp.catch_all('/light3/loadsave/%d/1' % (1000 + i), [0.0])
+        self.assertEqual(mock_sync.call_count, 100)
+        self.assertEqual(len(amcp.routes), routes)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,668 @@
+import cPickle
+import json
+import numpy
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import effects
+from bench import opcsink
+from effects import cloud, fastopc, golden, governor, layout, playback, presets, profiler, remote
+
+controller = effects.LightController()
+
+
+def renderArgs(lightning=()):
+    return (controller.model.packed, controller._makeCloudMatrix(),
+        controller._generateColorBuffer(), controller.params.contrast, list(lightning))
+
+
+class TestCloudRender(unittest.TestCase):
+
+    def tearDown(self):
+        cloud.set_threads(1)
+        cloud.set_vectorized(True)
+
+    def test_threaded_render_matches_single(self):
+        args = renderArgs([(0.1, 0.2, 0.3, 1.0, 1.0, 1.0, 20.0)])
+        cloud.set_threads(1)
+        expected = str(cloud.render(*args))
+        for threads in (2, 3, 4, 7):
+            cloud.set_threads(threads)
+            self.assertEqual(cloud.get_threads(), threads)
+            self.assertEqual(str(cloud.render(*args)), expected)
+
+    def test_small_model_with_more_threads_than_strips(self):
+        # Only two strips' worth of pixels, so most workers have nothing to do
+        model = effects.Model(points=controller.model.points[:130])
+        lc = effects.LightController(model, opc=fastopc.NullOPC())
+        args = (model.packed, lc._makeCloudMatrix(), lc._generateColorBuffer(),
+            lc.params.contrast, [(0.1, 0.2, 0.3, 1.0, 1.0, 1.0, 20.0)])
+        cloud.set_threads(1)
+        expected = str(cloud.render(*args))
+
+        for threads in (4, 8):
+            cloud.set_threads(threads)
+            out = bytearray('\xaa' * (len(expected) + 512))
+            cloud.render_into(out, 0, *args)
+            self.assertEqual(str(out[:len(expected)]), expected)
+            self.assertEqual(str(out[len(expected):]), '\xaa' * 512)
+
+    def test_vectorized_render_matches_scalar(self):
+        args = renderArgs()
+        cloud.set_vectorized(False)
+        scalar = numpy.frombuffer(str(cloud.render(*args)), numpy.uint8).astype(int)
+        cloud.set_vectorized(True)
+        vector = numpy.frombuffer(str(cloud.render(*args)), numpy.uint8).astype(int)
+        self.assertTrue(numpy.abs(scalar - vector).max() <= 1)
+
+    def test_render_into_matches_render(self):
+        args = renderArgs([(0.1, 0.2, 0.3, 1.0, 1.0, 1.0, 20.0)])
+        expected = str(cloud.render(*args))
+        out = bytearray(len(expected) + 7)
+        packedMatrix = numpy.array(args[1], numpy.float32)
+        packedLightning = numpy.array(args[4], numpy.float32)
+        cloud.render_into(out, 4, args[0], packedMatrix, args[2], args[3], packedLightning)
+        self.assertEqual(str(out[4:-3]), expected)
+        self.assertEqual(str(out[:4] + out[-3:]), '\0' * 7)
+        self.assertRaises(ValueError, cloud.render_into, out, 8, *args)
+
+    def test_lightning_culling(self):
+        lightning = [(x * 0.5, 0.0, 0.0, 1.0, 0.5, 0.2, 50.0) for x in range(-4, 5)]
+        args = renderArgs(lightning)
+        expected = str(cloud.render(*args))
+
+        # A vanishingly small threshold reaches every cell, so nothing changes
+        culled = str(cloud.render(*args, grid=controller.model.grid, threshold=1e-9))
+        self.assertEqual(culled, expected)
+
+        # At a visible threshold, each skipped bolt changes a channel by less than one step
+        culled = cloud.render(*args, grid=controller.model.grid, threshold=1 / 255.0)
+        diff = (numpy.frombuffer(str(culled), numpy.uint8).astype(int) -
+            numpy.frombuffer(expected, numpy.uint8).astype(int))
+        self.assertTrue(numpy.abs(diff).max() <= len(lightning))
+
+    def test_noise_parameters(self):
+        args = renderArgs()
+        expected = str(cloud.render(*args))
+        self.assertEqual(str(cloud.render(*args, octaves=4, persistence=0.5, lacunarity=2.0)), expected)
+        self.assertNotEqual(str(cloud.render(*args, octaves=2)), expected)
+        self.assertNotEqual(str(cloud.render(*args, persistence=0.8)), expected)
+        self.assertNotEqual(str(cloud.render(*args, lacunarity=3.0)), expected)
+        self.assertRaises(ValueError, cloud.render, *args, octaves=0)
+        self.assertRaises(ValueError, cloud.render, *args, octaves=cloud.MAX_OCTAVES + 1)
+
+    def test_thread_count_limits(self):
+        self.assertRaises(ValueError, cloud.set_threads, 0)
+        self.assertRaises(ValueError, cloud.set_threads, 1000)
+
+
+class TestLightController(unittest.TestCase):
+
+    def test_idle_frames_skip_rendering(self):
+        sink = opcsink.OPCSink()
+        lc = effects.LightController(server=sink.server, keepalive=60)
+        lc.params.lightning_new = 0
+        lc.params.brightness = 0
+        for i in range(3):
+            lc._drawFrame(1 / 30.0)
+        self.assertEqual(lc.skippedRenders, 2)
+        self.assertEqual(lc.opc.suppressed, 2)
+
+        # Any visible change renders again
+        lc.params.brightness = 0.5
+        lc._drawFrame(1 / 30.0)
+        self.assertEqual(lc.skippedRenders, 2)
+        self.assertTrue(sink.waitForMessages(2))
+        sink.close()
+
+    def test_headless_with_fake_clock(self):
+        clock = profiler.FakeClock()
+        opc = fastopc.NullOPC()
+        model = effects.Model(points=controller.model.points[:100])
+        lc = effects.LightController(model, opc=opc, clock=clock, sleep=clock.sleep)
+        for i in range(30):
+            lc.runFrame()
+        self.assertAlmostEqual(clock(), 1.0)
+        self.assertEqual(opc.messages, 30)
+        self.assertEqual(len(opc.lastMessage), 4 + 100 * 3 + 3)
+
+    def test_transition(self):
+        clock = profiler.FakeClock()
+        model = effects.Model(points=controller.model.points[:100])
+        lc = effects.LightController(model, opc=fastopc.NullOPC(), clock=clock, sleep=clock.sleep)
+        lc.runFrame()
+
+        target = effects.LightParameters()
+        target.brightness = 0.2
+        target.rotation = -3.0
+        lc.params.rotation = 3.0
+        lc.transitionTo(target, 1.0)
+
+        # Halfway, and the short way around for angles
+        for i in range(15):
+            lc.runFrame()
+        self.assertAlmostEqual(lc.params.brightness, 0.5, 2)
+        self.assertTrue(lc.params.rotation > 3.0)
+
+        # A direct change wins over the transition
+        lc.params.detail = 2.0
+        for i in range(30):
+            lc.runFrame()
+        self.assertEqual(lc.params.brightness, 0.2)
+        self.assertEqual(lc.params.rotation, -3.0)
+        self.assertEqual(lc.params.detail, 2.0)
+        self.assertEqual(lc._transitions, {})
+
+
+class TestLayoutCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'layout.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def writeLayout(self, points):
+        with open(self.filename, 'w') as f:
+            json.dump([{'point': p} for p in points], f)
+
+    def test_cache_matches_json(self):
+        shutil.copy(controller.model.filename, self.filename)
+        first = effects.Model(self.filename)
+        self.assertTrue(os.path.exists(layout.cacheFilename(self.filename)))
+        second = effects.Model(self.filename)
+        self.assertTrue(numpy.array_equal(first.points, controller.model.points))
+        self.assertTrue(numpy.array_equal(second.points, controller.model.points))
+        self.assertEqual(second.grid, controller.model.grid)
+        self.assertEqual(len(second.graphData), len(second.points))
+
+    def test_changed_layout_ignores_cache(self):
+        self.writeLayout([[0, 0, 0], [1, 2, 3]])
+        effects.Model(self.filename)
+
+        # Same size, so only the modification time tells them apart
+        self.writeLayout([[0, 0, 0], [1, 2, 4]])
+        mtime = os.path.getmtime(self.filename)
+        os.utime(self.filename, (mtime + 1, mtime + 1))
+        self.assertEqual(effects.Model(self.filename).points[1, 2], 4)
+
+
+class TestPresets(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_pack(self):
+        params = effects.LightParameters()
+        params.octaves = 7
+        data = presets.pack(params)
+        self.assertEqual(len(data), presets.HEADER.size + len(presets.FIELDS) * 8)
+        self.assertEqual(presets.unpack(data).octaves, 7)
+        self.assertRaises(ValueError, presets.unpack, data[:-1])
+        self.assertRaises(ValueError, presets.unpack, 'x' * len(data))
+
+    def test_store(self):
+        params = effects.LightParameters()
+        params.detail = 1.25
+        store = presets.PresetStore(self.tempdir)
+        store.save(3, params)
+        params.detail = 0
+        self.assertEqual(store.get(3).detail, 1.25)
+        self.assertEqual(store.get(4), None)
+
+        self.assertTrue(store.flush(timeout=5))
+        self.assertEqual(os.listdir(self.tempdir), ['preset3.preset'])
+        self.assertEqual(presets.PresetStore(self.tempdir).get(3).detail, 1.25)
+
+    def test_pickled_presets(self):
+        params = effects.LightParameters()
+        params.contrast = 4.0
+        with open(os.path.join(self.tempdir, 'preset2.pickle'), 'wb') as f:
+            cPickle.dump(params, f)
+
+        store = presets.PresetStore(self.tempdir)
+        self.assertEqual(store.get(2).contrast, 4.0)
+        store.flush()
+        self.assertTrue(os.path.exists(store.filename(2)))
+
+
+class TestGoldenFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'golden.npz')
+
+    def tearDown(self):
+        cloud.set_vectorized(True)
+        shutil.rmtree(self.tempdir)
+
+    def test_seeded_frames_repeat(self):
+        a = golden.checksums(golden.renderFrames(golden.makeController(seed=5), 30))
+        b = golden.checksums(golden.renderFrames(golden.makeController(seed=5), 30))
+        c = golden.checksums(golden.renderFrames(golden.makeController(seed=6), 30))
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_compare_with_tolerance(self):
+        golden.record(self.filename, count=30)
+        self.assertEqual(golden.compare(self.filename)['differing'], 0)
+
+        # The scalar noise path may round differently, but only by one step
+        cloud.set_vectorized(False)
+        result = golden.compare(self.filename, tolerance=1)
+        self.assertTrue(result['ok'])
+        self.assertTrue(result['max_diff'] <= 1)
+
+
+class TestShowPlayback(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_show_file_formats(self):
+        frames = [chr(i) * 6 for i in range(70)]
+        for compress in (False, True):
+            filename = os.path.join(self.tempdir, 'show%d' % compress)
+            writer = playback.ShowWriter(filename, 6, compress=compress)
+            for frame in frames:
+                writer.write(frame)
+            writer.close()
+
+            show = playback.ShowFile(filename)
+            self.assertEqual((show.frameCount, show.compressed), (70, compress))
+            self.assertEqual([str(show.frame(i)) for i in range(70)], frames)
+            show.close()
+
+    def test_play_and_crossfade(self):
+        filename = os.path.join(self.tempdir, 'show')
+        playback.renderShow(filename, 2, seed=3)
+        show = playback.ShowFile(filename)
+
+        clock = profiler.FakeClock()
+        lc = effects.LightController(opc=fastopc.NullOPC(), clock=clock, sleep=clock.sleep)
+        lc.playShow(show, fade=0.5)
+        header = str(lc._frame[:4])
+
+        # Halfway through, only the show is visible
+        for i in range(30):
+            lc.runFrame()
+        self.assertEqual(lc.playback.mix(lc.time), 1.0)
+        message = lc.opc.lastMessage
+        self.assertEqual(str(message[4:-3]), str(lc.playback.frame(lc.time)))
+        self.assertEqual(len(message), 4 + show.frameBytes + 3)
+
+        # Then it fades back to the live effect, and stops
+        for i in range(31):
+            lc.runFrame()
+        self.assertEqual(lc.playback, None)
+        lc.runFrame()
+        self.assertEqual(str(lc.opc.lastMessage[:4]), header)
+        self.assertNotEqual(str(lc.opc.lastMessage[4:-3]), str(show.frame(59)))
+
+
+class TestRemoteLightController(unittest.TestCase):
+
+    def test_parameter_block(self):
+        block = remote.ParameterBlock()
+        params = effects.LightParameters()
+        params.detail = 2.5
+        block.write(params)
+
+        copy = effects.LightParameters()
+        self.assertTrue(block.read(copy))
+        self.assertEqual(copy.detail, 2.5)
+        self.assertFalse(block.read(copy))
+
+        # Only changes are reported, with their duration
+        params.brightness = 0.1
+        block.write(params, 2.0)
+        self.assertEqual(block.read(copy), [('brightness', 2.0)])
+
+        # A direct change during a transition leaves the other fields' duration alone
+        params.detail = 1.0
+        block.write(params, 3.0, ['detail'])
+        params.brightness = 0.2
+        block.write(params, names=['brightness'])
+        self.assertEqual(block.read(copy), [('brightness', 0.0), ('detail', 3.0)])
+
+        for i in range(block.ringSize + 2):
+            block.trigger(i, 0, 0)
+        triggers = block.triggers()
+        self.assertEqual(len(triggers), block.ringSize)
+        self.assertEqual(triggers[-1], (block.ringSize + 1, 0, 0))
+        self.assertEqual(block.triggers(), [])
+
+    def test_render_process(self):
+        sink = opcsink.OPCSink()
+        lc = remote.RemoteLightController(server=sink.server)
+        try:
+            self.assertTrue(sink.waitForMessages(3))
+
+            # Parameter changes reach the render process
+            lc.params.lightning_new = 0
+            lc.params.brightness = 0
+            deadline = time.time() + 5
+            while time.time() < deadline and sink.lastMessage[0][1].strip('\0'):
+                time.sleep(0.05)
+            self.assertEqual(sink.lastMessage[0][1].strip('\0'), '')
+        finally:
+            lc.close()
+            sink.close()
+
+    def test_render_process_restarts(self):
+        sink = opcsink.OPCSink()
+        lc = remote.RemoteLightController(server=sink.server)
+        try:
+            self.assertTrue(sink.waitForMessages(3))
+            os.kill(childPids(lc.process.pid)[0], signal.SIGKILL)
+
+            deadline = time.time() + 5
+            while time.time() < deadline and not lc.restarts:
+                lc.runFrame()
+                time.sleep(0.05)
+            self.assertEqual(lc.restarts, 1)
+            self.assertTrue(sink.waitForMessages(sink.messages + 3))
+        finally:
+            lc.close()
+            sink.close()
+
+
+def childPids(parent):
+    # Linux only: scan /proc for processes whose parent is 'parent'
+    pids = []
+    for name in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == parent:
+            pids.append(int(name))
+    return pids
+
+
+class TestFrameGovernor(unittest.TestCase):
+
+    def test_degrades_and_recovers_with_hysteresis(self):
+        lc = effects.LightController(targetFPS=30, maxLightning=10, profile=True, adaptive=True)
+        g = lc.governor
+        g.smoothing = 1.0   # No averaging, so frame counts are exact
+        self.assertEqual((lc.octaves, lc.maxLightning), (cloud.MAX_OCTAVES, 10))
+
+        # Overloaded: step down one level per 'patience' frames
+        for i in range(g.patience * 3):
+            g.update(0.050)
+        self.assertEqual(g.level, 3)
+        self.assertEqual((lc.octaves, lc.maxLightning), (2, 5))
+
+        # Between the watermarks, nothing changes
+        for i in range(g.recovery * 2):
+            g.update(0.7 / lc.targetFPS)
+        self.assertEqual(g.level, 3)
+
+        # Light load: recover, more slowly than we degraded
+        for i in range(g.recovery * 2):
+            g.update(0.001)
+        self.assertEqual(g.level, 1)
+        for i in range(g.recovery * 2):
+            g.update(0.001)
+        self.assertEqual(g.level, 0)
+        self.assertEqual((lc.octaves, lc.maxLightning, lc.targetFPS), (cloud.MAX_OCTAVES, 10, 30))
+        self.assertAlmostEqual(lc.profiler.budget, 1 / 30.0)
+
+    def test_lightning_stays_off(self):
+        lc = effects.LightController(maxLightning=0, profile=True, adaptive=True)
+        g = lc.governor
+        g.smoothing = 1.0
+        self.assertEqual(lc.maxLightning, 0)
+        for i in range(g.patience * (len(g.levels) - 1)):
+            g.update(0.050)
+        self.assertEqual(g.level, len(g.levels) - 1)
+        self.assertEqual(lc.maxLightning, 0)
+
+
+class TestFrameProfiler(unittest.TestCase):
+
+    def test_stages_and_missed_deadlines(self):
+        now = [0.0]
+        p = profiler.FrameProfiler(budget=0.010, clock=lambda: now[0])
+        for work in (0.002, 0.004, 0.020):
+            now[0] += 0.005
+            p.begin()
+            now[0] += work
+            p.mark('render')
+            p.end()
+
+        report = p.report()
+        self.assertEqual(report['frames'], 3)
+        self.assertEqual(report['missed'], 1)
+        self.assertAlmostEqual(report['stages']['render']['max'], 0.020)
+        self.assertAlmostEqual(report['stages']['idle']['p50'], 0.005)
+        self.assertFalse('send' in report['stages'])
+
+    def test_input_latency(self):
+        now = [0.0]
+        p = profiler.FrameProfiler(budget=0.010, clock=lambda: now[0])
+        p.begin()
+        p.input()
+        now[0] += 0.004
+        p.input()
+        now[0] += 0.006
+        p.end()
+        p.begin()
+        p.end()
+
+        latency = p.report()['stages']['input']
+        self.assertEqual(latency['count'], 1)
+        self.assertAlmostEqual(latency['max'], 0.010)
+
+
+class TestFastOPC(unittest.TestCase):
+
+    def test_unix_socket_transport(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            sink = opcsink.OPCSink('unix:' + os.path.join(tempdir, 'opc.sock'))
+            opc = fastopc.FastOPC(sink.server)
+            self.assertEqual(opc.family, socket.AF_UNIX)
+
+            opc.putPixels(2, [(1, 2, 3), (4, 5, 6)])
+            self.assertTrue(sink.waitForMessages(1))
+            self.assertEqual(sink.lastMessage[2], (0, '\x01\x02\x03\x04\x05\x06'))
+            sink.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_send_parts(self):
+        sink = opcsink.OPCSink()
+        opc = fastopc.FastOPC(sink.server)
+        pixels = bytearray('xxabcdefxx')
+        self.assertTrue(opc.sendParts('\1\0\0\6', buffer(pixels, 2, 6)))
+        self.assertTrue(sink.waitForMessages(1))
+        self.assertEqual(sink.lastMessage[1], (0, 'abcdef'))
+        sink.close()
+
+    def test_hangup(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        opc = fastopc.FastOPC('127.0.0.1:%d' % listener.getsockname()[1])
+        self.assertTrue(opc.send(opc.makeFrame(0, 3)))
+        conn, addr = listener.accept()
+        conn.close()
+
+        self.assertTrue(select.select([opc.selectable()], [], [], 2)[0])
+        opc.hangup()
+        self.assertEqual(opc.selectable(), None)
+        listener.close()
+
+    def test_send_error_closes_socket(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        opc = fastopc.FastOPC('127.0.0.1:%d' % listener.getsockname()[1])
+        self.assertTrue(opc.send(opc.makeFrame(0, 3)))
+        conn, addr = listener.accept()
+        listener.close()
+        conn.close()
+
+        old = opc.socket
+        for i in range(10):
+            if not opc.send(opc.makeFrame(0, 3)):
+                break
+        self.assertEqual(opc.socket, None)
+        self.assertRaises(socket.error, old.fileno)
+
+    def test_identical_frames_suppressed(self):
+        sink = opcsink.OPCSink()
+        opc = fastopc.FastOPC(sink.server, keepalive=60)
+        frame = opc.makeFrame(0, 6)
+        for i in range(5):
+            self.assertTrue(opc.sendFrame(frame))
+        frame[4] = 1
+        opc.sendFrame(frame)
+
+        self.assertTrue(sink.waitForMessages(2))
+        self.assertEqual(opc.suppressed, 4)
+        self.assertEqual(sink.lastMessage[0], (0, '\x01' + '\0' * 5))
+        sink.close()
+
+
+class TestMultiOPC(unittest.TestCase):
+
+    def test_channels_and_servers(self):
+        sinks = [opcsink.OPCSink(), opcsink.OPCSink()]
+        outputs = [
+            {'server': sinks[0].server, 'channel': 1, 'first': 0, 'count': 60},
+            {'server': sinks[0].server, 'channel': 2, 'first': 60, 'count': 20},
+            {'server': sinks[1].server, 'channel': 1, 'first': 80, 'count': 21},
+        ]
+        model = effects.Model(points=controller.model.points[:100])
+        lc = effects.LightController(model, outputs=outputs)
+        try:
+            self.assertEqual(len(lc.opc.clients), 2)
+            lc.dmx[0] = (7, 8, 9)
+            lc._drawFrame(1 / 30.0)
+            self.assertTrue(sinks[0].waitForMessages(2))
+            self.assertTrue(sinks[1].waitForMessages(1))
+
+            frame = str(lc._frame)
+            self.assertEqual(sinks[0].lastMessage[1], (0, frame[4:4 + 180]))
+            self.assertEqual(sinks[0].lastMessage[2], (0, frame[184:184 + 60]))
+            self.assertEqual(sinks[1].lastMessage[1], (0, frame[244:]))
+            self.assertEqual(sinks[1].lastMessage[1][1][-3:], '\x07\x08\x09')
+
+            # The next frame reuses the same buffer, and its new contents go out
+            lc.dmx[0] = (1, 2, 3)
+            lc._drawFrame(1 / 30.0)
+            self.assertTrue(sinks[1].waitForMessages(2))
+            self.assertEqual(sinks[1].lastMessage[1][1][-3:], '\x01\x02\x03')
+        finally:
+            lc.opc.close()
+            for sink in sinks:
+                sink.close()
+
+    def test_unreachable_server_never_stalls(self):
+        sink = opcsink.OPCSink()
+        outputs = [
+            {'server': sink.server, 'channel': 1, 'first': 0, 'count': 50},
+            {'server': '127.0.0.1:1', 'channel': 1, 'first': 50, 'count': 51},
+        ]
+        model = effects.Model(points=controller.model.points[:100])
+        lc = effects.LightController(model, outputs=outputs)
+        try:
+            start = time.time()
+            for i in range(20):
+                lc.params.brightness = i / 20.0
+                lc._drawFrame(1 / 30.0)
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertTrue(sink.waitForMessages(1))
+        finally:
+            lc.opc.close()
+            sink.close()
+
+    def test_outputs_checked(self):
+        outputs = [{'server': '127.0.0.1:1', 'channel': 1, 'first': 0, 'count': 50}]
+        opc = fastopc.MultiOPC(outputs)
+        self.assertRaises(ValueError, opc.makeFrame, 0, 100)
+        opc.close()
+        outputs[0]['count'] = 30000
+        self.assertRaises(ValueError, fastopc.MultiOPC, outputs)
+
+
+class TestThreadedOPC(unittest.TestCase):
+
+    def test_send_never_blocks(self):
+        # Nothing is listening here
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        opc = fastopc.ThreadedOPC('127.0.0.1:%d' % port)
+        start = time.time()
+        for i in range(100):
+            opc.send(opc.makeFrame(0, 30))
+        self.assertTrue(time.time() - start < 0.1)
+        opc.close()
+        self.assertEqual(opc.stats()['sent'], 0)
+        self.assertTrue(opc.stats()['dropped'] > 0)
+
+    def test_sends_latest_frame(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        opc = fastopc.ThreadedOPC('127.0.0.1:%d' % listener.getsockname()[1])
+
+        frame = opc.makeFrame(0, 3)
+        frame[4:] = 'abc'
+        opc.send(frame)
+        conn, addr = listener.accept()
+        conn.settimeout(2)
+        self.assertEqual(conn.recv(7), '\0\0\0\x03abc')
+
+        opc.close()
+        conn.close()
+        listener.close()
+
+    def test_close_with_wedged_server(self):
+        # The server accepts, then never reads
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        opc = fastopc.ThreadedOPC('127.0.0.1:%d' % listener.getsockname()[1])
+        opc.sendTimeout = 0.2
+
+        frame = opc.makeFrame(0, 60000)
+        opc.send(frame)
+        conn, addr = listener.accept()
+        deadline = time.time() + 5
+        while time.time() < deadline and not opc.stats()['disconnects']:
+            opc.send(frame)
+            time.sleep(0.01)
+        self.assertTrue(opc.stats()['disconnects'] > 0)
+
+        closer = threading.Thread(target=opc.close)
+        closer.start()
+        closer.join(2)
+        self.assertFalse(closer.is_alive())
+        conn.close()
+        listener.close()
+
+
+if __name__ == '__main__':
+    unittest.main()